@@ -2,11 +2,178 @@ import pandas as pd
 import numpy as np
 import typing
 import os
+import hashlib
+import pickle
+import types
+from profiling import profiler, profiled
+
+KB_CACHE_DIR = '.kb_cache'
+KB_CACHE_VERSION = 2  # bump when the cached attributes change
+TYPED_VALUE_COLUMNS = ['Numeric value', 'Text value']  # typed copies of the Value column (see typed_values)
+
+def _cache_path(path:typing.Union[str, bytes, os.PathLike]) -> str:
+	"""
+	Get the path of the binary cache of a knowledge base spreadsheet.
+	"""
+	path = os.fsdecode(path)
+	return os.path.join(os.path.dirname(path), KB_CACHE_DIR, os.path.basename(path) + '.pkl')
+
+def _file_hash(path:typing.Union[str, bytes, os.PathLike]) -> str:
+	"""
+	Get the sha256 hash of a file.
+	"""
+	with open(path, 'rb') as f:
+		return hashlib.sha256(f.read()).hexdigest()
+
+def _read_kb_cache(path:typing.Union[str, bytes, os.PathLike]) -> typing.Optional[dict]:
+	"""
+	Read the binary cache of a knowledge base spreadsheet.
+	The cache is used when the spreadsheet has the same mtime and size, or else the same hash.
+	Args:
+		path: path of the spreadsheet
+	Returns:
+		dict: cached attributes, None if there is no valid cache
+	"""
+	try:
+		stat = os.stat(path)
+		with open(_cache_path(path), 'rb') as f:
+			cache = pickle.load(f)
+	except Exception:
+		return None
+	if cache.get('version') != KB_CACHE_VERSION:
+		return None
+	if (cache['mtime_ns'], cache['size']) == (stat.st_mtime_ns, stat.st_size):
+		return cache['data']
+	if cache['sha256'] == _file_hash(path):
+		_write_kb_cache(path, cache['data'])  # touched but not changed, refresh the mtime
+		return cache['data']
+	return None
+
+def _write_kb_cache(path:typing.Union[str, bytes, os.PathLike], data:dict) -> None:
+	"""
+	Write the binary cache of a knowledge base spreadsheet, the cache is skipped if it cannot be written.
+	Args:
+		path: path of the spreadsheet
+		data: attributes to cache
+	"""
+	cache_path = _cache_path(path)
+	try:
+		stat = os.stat(path)
+		os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+		with open(cache_path + '.tmp', 'wb') as f:
+			pickle.dump({'version': KB_CACHE_VERSION, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': _file_hash(path), 'data': data}, f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(cache_path + '.tmp', cache_path)
+	except OSError:
+		pass
+
+def typed_values(values:pd.Series) -> (pd.Series, pd.Series):
+	"""
+	Split the Value column into a numeric and a text column, once when the rows are loaded,
+	so the inference does not coerce the values again (see inference_dec_batch).
+	Args:
+		values (pd.Series): Value column of the database
+	Returns:
+		pd.Series: numeric values (float64, NaN where the value is not a number)
+		pd.Series: text values (categorical, NaN where the value is not a text)
+	"""
+	value_num = pd.to_numeric(values, errors='coerce').astype(float)
+	is_txt = value_num.isna().to_numpy() & values.map(lambda x: isinstance(x, str)).to_numpy(dtype=bool)
+	value_txt = values.where(is_txt).astype('category')
+	return value_num, value_txt
+
+def _typed_observations(df_db:pd.DataFrame) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+	# numeric values, text values, text mask and the values of mixed type, from the typed columns if present
+	# (or split by typed_values here, so the inference and the typed columns follow the same rules)
+	if TYPED_VALUE_COLUMNS[0] in df_db.columns and TYPED_VALUE_COLUMNS[1] in df_db.columns:
+		value_num, value_txt = df_db[TYPED_VALUE_COLUMNS[0]], df_db[TYPED_VALUE_COLUMNS[1]]
+	else:
+		value_num, value_txt = typed_values(df_db['Value'])
+	value_num = value_num.to_numpy(dtype=float)
+	if not isinstance(value_txt.dtype, pd.CategoricalDtype):
+		value_txt = value_txt.astype('category')
+	codes = value_txt.cat.codes.to_numpy()
+	is_txt = codes >= 0
+	value_txt = np.append(value_txt.cat.categories.to_numpy(dtype=str), '')[codes]
+	values = np.where(is_txt, value_txt.astype(object), value_num.astype(object))
+	return value_num, value_txt, is_txt, values
+
+def _lookup(keys:pd.Series, values:pd.Series) -> types.MappingProxyType:
+	"""
+	Read-only lookup dictionary of a sheet, the keys that are not unique are left out (as .item() fails on them).
+	"""
+	unique = ~keys.duplicated(keep=False)
+	return types.MappingProxyType(dict(zip(keys[unique], values[unique])))
+
+def _unwrap(compiled_kb:typing.Optional[typing.Mapping]) -> typing.Optional[dict]:
+	"""
+	Plain dictionaries of the read-only compiled knowledge base, to pickle it (a mappingproxy cannot be pickled).
+	"""
+	if compiled_kb is None:
+		return None
+	return {key: dict(value) if isinstance(value, types.MappingProxyType) else value for key, value in compiled_kb.items()}
+
+def _wrap(compiled_kb:typing.Optional[dict]) -> typing.Optional[types.MappingProxyType]:
+	"""
+	Read-only compiled knowledge base from its plain dictionaries.
+	"""
+	if compiled_kb is None:
+		return None
+	return types.MappingProxyType({key: types.MappingProxyType(value) if isinstance(value, dict) else value
+								   for key, value in compiled_kb.items()})
+
+def _map_lookup(keys:pd.Series, lookup:typing.Mapping) -> pd.Series:
+	if isinstance(keys.dtype, pd.CategoricalDtype):
+		keys = keys.astype(object)
+	return keys.map(lookup)
+
+class _IntervalTable:
+	"""
+	Interval rules of a knowledge base sheet, sorted by LOINC-NUM.
+	A value matches a rule when scale_low <= value <= scale_top, numeric bounds are
+	compared with numeric values and text bounds with text values.
+	"""
+	def __init__(self, loinc_num:pd.Series, scale_low:pd.Series, scale_top:pd.Series) -> None:
+		loinc_num = loinc_num.astype(str).to_numpy()
+		self.order = np.argsort(loinc_num, kind='stable')
+		self.loinc_num = loinc_num[self.order]
+
+		low = scale_low.to_numpy(dtype=object)[self.order]
+		top = scale_top.to_numpy(dtype=object)[self.order]
+		self.low_num = pd.to_numeric(pd.Series(low, dtype=object), errors='coerce').to_numpy(dtype=float)
+		self.top_num = pd.to_numeric(pd.Series(top, dtype=object), errors='coerce').to_numpy(dtype=float)
+		self.is_num = ~(np.isnan(self.low_num) | np.isnan(self.top_num))
+		self.low_txt = np.where(self.is_num, '', low).astype(str)
+		self.top_txt = np.where(self.is_num, '', top).astype(str)
+
+	def match(self, loinc_num:np.ndarray, value_num:np.ndarray, value_txt:np.ndarray, is_txt:np.ndarray) -> (np.ndarray, np.ndarray):
+		"""
+		Match the observations against the rules.
+		Args:
+			loinc_num (np.ndarray): LOINC-NUM of the observations
+			value_num (np.ndarray): numeric values of the observations
+			value_txt (np.ndarray): text values of the observations
+			is_txt (np.ndarray): mask of the text values
+		Returns:
+			np.ndarray: positions of the matched observations
+			np.ndarray: rows of the matched rules, in the sheet order for each observation
+		"""
+		start = np.searchsorted(self.loinc_num, loinc_num, side='left')
+		count = np.searchsorted(self.loinc_num, loinc_num, side='right') - start
+		obs = np.repeat(np.arange(len(loinc_num)), count)
+		pos = np.repeat(start - np.cumsum(count) + count, count) + np.arange(count.sum())
+
+		is_num = self.is_num[pos]
+		num = value_num[obs]
+		txt = value_txt[obs]
+		hit = is_num & (num >= self.low_num[pos]) & (num <= self.top_num[pos])
+		hit |= ~is_num & is_txt[obs] & (txt >= self.low_txt[pos]) & (txt <= self.top_txt[pos])
+		return obs[hit], self.order[pos[hit]]
+
 
 class KB_Dec:
-	def __init__(self, path:typing.Union[str, bytes, os.PathLike]=None) -> None:
+	def __init__(self, path:typing.Union[str, bytes, os.PathLike]=None, use_cache:bool=True) -> None:
 		if path is not None:
-			self.load_kb_dec(path)
+			self.load_kb_dec(path, use_cache=use_cache)
 		else:
 			self.df_map_1_1 = pd.DataFrame()
 			self.df_map_2_1 = pd.DataFrame()
@@ -15,11 +182,21 @@ class KB_Dec:
 			self.df_loinc = pd.DataFrame()
 			self.df_states = pd.DataFrame()
 			self.df_filter_condition = pd.DataFrame()
+			self.compiled_kb = None
 	
-	def load_kb_dec(self, path:typing.Union[str, bytes, os.PathLike]) -> None:
+	@profiled('kb_dec.load')
+	def load_kb_dec(self, path:typing.Union[str, bytes, os.PathLike], use_cache:bool=True) -> None:
 		"""
 		Load the Declarative knowledge base.
+		Args:
+			path: path of the spreadsheet
+			use_cache (bool): load from (and save to) the binary cache of the spreadsheet
 		"""
+		cache = _read_kb_cache(path) if use_cache else None
+		if cache is not None:
+			self.__setstate__(cache)
+			return
+
 		self.df_map_1_1 = pd.read_excel(path, sheet_name='1_1')
 		
 		self.df_map_2_1 = pd.read_excel(path, sheet_name='2_1')
@@ -35,6 +212,39 @@ class KB_Dec:
 
 		self.df_filter_condition = pd.read_excel(path, sheet_name='filter_condition')
 
+		self.compile_kb_dec()
+
+		if use_cache:
+			_write_kb_cache(path, self.__getstate__())
+
+	def __getstate__(self) -> dict:
+		state = dict(self.__dict__)
+		state['compiled_kb'] = _unwrap(state.get('compiled_kb'))
+		return state
+
+	def __setstate__(self, state:dict) -> None:
+		self.__dict__.update(state)
+		self.compiled_kb = _wrap(state.get('compiled_kb'))
+
+	def compile_kb_dec(self) -> None:
+		"""
+		Compile the rule sheets into interval tables sorted by LOINC-NUM,
+		the best_before sheet into timedeltas indexed by LOINC-NUM
+		and the LOINC and states sheets into lookup dictionaries.
+		The compiled tables and the lookup dictionaries are read-only (types.MappingProxyType).
+		"""
+		self.compiled_kb = types.MappingProxyType({
+			'1_1': _IntervalTable(self.df_map_1_1['LOINC-NUM'], self.df_map_1_1['scale_low'], self.df_map_1_1['scale_top']),
+			'2_1_1': _IntervalTable(self.df_map_2_1['LOINC-NUM_1'], self.df_map_2_1['scale_low_1'], self.df_map_2_1['scale_top_1']),
+			'2_1_2': _IntervalTable(self.df_map_2_1['LOINC-NUM_2'], self.df_map_2_1['scale_low_2'], self.df_map_2_1['scale_top_2']),
+			'maximal_or': _IntervalTable(self.df_map_max_or['LOINC-NUM'], self.df_map_max_or['scale_low'], self.df_map_max_or['scale_top']),
+			'best_before': pd.DataFrame({
+				'good_before': pd.to_timedelta(self.df_best_before['good_before_value'].astype(str) + ' ' + self.df_best_before['good_before_time_unit']).to_numpy(),
+				'good_after': pd.to_timedelta(self.df_best_before['good_after_value'].astype(str) + ' ' + self.df_best_before['good_after_time_unit']).to_numpy(),
+				}, index=self.df_best_before['LOINC-NUM'].to_numpy()),
+			'loinc_desc': _lookup(self.df_loinc['LOINC-NUM'], self.df_loinc['LONG_COMMON_NAME']),
+			'states': _lookup(self.df_states['Therapy_Code'], self.df_states['Therapy_desc']),
+		})
 
 	def inference_dec(self, df_db: pd.DataFrame) -> pd.DataFrame:
 		"""
@@ -46,29 +256,70 @@ class KB_Dec:
 		Returns:
 			df_inferred: dataframe of inferred knowledge
 		"""
-		df_db['Value'] = pd.to_numeric(df_db['Value'],errors='coerce').fillna(df_db['Value']).tolist()
-		joined_1_1 = pd.merge(df_db, self.df_map_1_1, left_on='LOINC-NUM', right_on='LOINC-NUM', how='inner', suffixes=('_db', '_kb'))
-		joined_1_1 = joined_1_1[joined_1_1.Value_db.between(joined_1_1.scale_low, joined_1_1.scale_top)][['Therapy_Code', 'Value_kb']]
+		return self.inference_dec_batch(df_db, key=None)
+
+	@profiled('kb_dec.inference')
+	def inference_dec_batch(self, df_db: pd.DataFrame, key:str='ID') -> pd.DataFrame:
+		"""
+		Perform inference on the Declarative knowledge base for all the patients at once.
+		Example:
+			df_inferred = inference_dec_batch(df_db[['ID', 'LOINC-NUM', 'Value']])
+		Args:
+			df_db: dataframe of the database (the typed value columns are used instead of Value when present)
+			key: column of the patient ID, None if df_db holds a single patient
+		Returns:
+			df_inferred: dataframe of inferred knowledge (with the key column if given)
+		"""
+		if self.compiled_kb is None:
+			self.compile_kb_dec()
+		group = '_key' if key is None else key
+		keys = np.zeros(len(df_db), dtype=int) if key is None else df_db[key].to_numpy()
+		loinc_num = df_db['LOINC-NUM'].astype(str).to_numpy()
+		value_num, value_txt, is_txt, values = _typed_observations(df_db)
+		observations = (loinc_num, value_num, value_txt, is_txt)
 
-		joined_2_1 = pd.merge(pd.merge(self.df_map_2_1, df_db, right_on='LOINC-NUM', left_on='LOINC-NUM_1', how='inner', suffixes=('_kb', '_db_1'), ), 
-						df_db, right_on='LOINC-NUM', left_on='LOINC-NUM_2', how='inner', suffixes=('_db_1', '_db_2')).rename(columns={'Value': 'Value_db_2'})
-		joined_2_1 = joined_2_1[joined_2_1.Value_db_1.between(joined_2_1.scale_low_1, joined_2_1.scale_top_1) & 
-			  					joined_2_1.Value_db_2.between(joined_2_1.scale_low_2, joined_2_1.scale_top_2)][['Therapy_Code', 'Value_kb']]
+		with profiler.span('kb_dec.1_1') as span:
+			obs, rule = self.compiled_kb['1_1'].match(*observations)
+			joined_1_1 = pd.DataFrame({group: keys[obs], 
+								 'Therapy_Code': self.df_map_1_1['Therapy_Code'].to_numpy()[rule], 
+								 'Value': self.df_map_1_1['Value'].to_numpy()[rule]})
+			span.set(rows=len(joined_1_1))
 
-		joined_max_or = pd.merge(df_db, self.df_map_max_or, left_on='LOINC-NUM', right_on='LOINC-NUM', how='inner', suffixes=('_db', '_kb'))
-		joined_max_or = joined_max_or[joined_max_or.Value_db.between(joined_max_or.scale_low, joined_max_or.scale_top)]
-		joined_max_or = joined_max_or.groupby('Therapy_Code')['Value_kb'].max().to_frame().reset_index()
+		with profiler.span('kb_dec.2_1') as span:
+			obs_1, rule_1 = self.compiled_kb['2_1_1'].match(*observations)
+			obs_2, rule_2 = self.compiled_kb['2_1_2'].match(*observations)
+			pairs = pd.merge(pd.DataFrame({group: keys[obs_1], 'rule': rule_1, 'obs_1': obs_1}), 
+					   pd.DataFrame({group: keys[obs_2], 'rule': rule_2, 'obs_2': obs_2}), on=[group, 'rule'], how='inner')
+			pairs = pairs.sort_values(['rule', 'obs_1', 'obs_2'], kind='stable')
+			rule = pairs['rule'].to_numpy()
+			joined_2_1 = pd.DataFrame({group: pairs[group].to_numpy(), 
+								 'Therapy_Code': self.df_map_2_1['Therapy_Code'].to_numpy()[rule], 
+								 'Value': self.df_map_2_1['Value'].to_numpy()[rule]})
+			span.set(rows=len(joined_2_1))
 
-		joined_all = pd.concat([joined_1_1, joined_2_1, joined_max_or]).reset_index(drop=True)
+		with profiler.span('kb_dec.maximal_or') as span:
+			obs, rule = self.compiled_kb['maximal_or'].match(*observations)
+			joined_max_or = pd.DataFrame({group: keys[obs], 
+									'Therapy_Code': self.df_map_max_or['Therapy_Code'].to_numpy()[rule], 
+									'Value': self.df_map_max_or['Value'].to_numpy()[rule]})
+			joined_max_or = joined_max_or.groupby([group, 'Therapy_Code'])['Value'].max().reset_index()
+			span.set(rows=len(joined_max_or))
 
-		df_db['dummy'] = 1
-		filter = pd.merge(df_db, self.df_filter_condition, how='outer', on=['LOINC-NUM', 'Value'])
-		filter = filter[filter['dummy'].isnull()]
-		df_db = df_db.drop(columns=['dummy'])
+		joined_all = pd.concat([joined_1_1, joined_2_1, joined_max_or]).sort_values(group, kind='stable')
 
-		joined_all = joined_all[~joined_all['Therapy_Code'].isin(filter['Therapy_Code'])]
+		with profiler.span('kb_dec.filter_condition') as span:
+			# a Therapy_Code is dropped when one of its filter conditions is not in the patient data
+			present = pd.DataFrame({group: keys, 'LOINC-NUM': df_db['LOINC-NUM'].to_numpy(), 'Value': values}).drop_duplicates()
+			filter = pd.merge(pd.DataFrame({group: pd.unique(keys)}), self.df_filter_condition, how='cross')
+			filter = pd.merge(filter, present, how='left', on=[group, 'LOINC-NUM', 'Value'], indicator=True)
+			filter = filter[filter['_merge'] == 'left_only'][[group, 'Therapy_Code']].drop_duplicates()
+			joined_all = pd.merge(joined_all, filter, how='left', on=[group, 'Therapy_Code'], indicator=True)
+			joined_all = joined_all[joined_all['_merge'] == 'left_only'].drop(columns=['_merge']).reset_index(drop=True)
+			span.set(rows=len(joined_all))
 
-		return joined_all.rename(columns={'Value_kb': 'Value'})
+		if key is None:
+			joined_all = joined_all.drop(columns=[group])
+		return joined_all
 	
 	def get_best_before(self, loinc_num:str) -> (pd.Timedelta, pd.Timedelta):
 		"""
@@ -79,9 +330,43 @@ class KB_Dec:
 			pd.Timedelta: Timedelta with the best before date
 			pd.Timedelta: Timedelta with the best after date
 		"""
-		df = self.df_best_before[self.df_best_before['LOINC-NUM'] == loinc_num]
-		return pd.Timedelta(f"{df['good_before_value'].item()} {df['good_before_time_unit'].item()}"), pd.Timedelta(f"{df['good_after_value'].item()} {df['good_after_time_unit'].item()}")
+		if self.compiled_kb is None:
+			self.compile_kb_dec()
+		df_best_before = self.compiled_kb['best_before']
+		if loinc_num not in df_best_before.index:
+			raise ValueError(f'unknown LOINC {loinc_num}')
+		good_before, good_after = df_best_before.loc[loinc_num]
+		return good_before, good_after
+
+	@profiled('kb_dec.best_before')
+	def get_best_before_batch(self, loinc_num:pd.Series) -> (pd.Series, pd.Series):
+		"""
+		Get the best before and best after timedeltas of many LOINC-NUMs.
+		Args:
+			loinc_num (pd.Series): LOINC-NUM
+		Returns:
+			pd.Series: best before timedeltas (NaT if the LOINC-NUM has no best before)
+			pd.Series: best after timedeltas (NaT if the LOINC-NUM has no best after)
+		"""
+		if self.compiled_kb is None:
+			self.compile_kb_dec()
+		df_best_before = self.compiled_kb['best_before']
+		if isinstance(loinc_num.dtype, pd.CategoricalDtype):
+			loinc_num = loinc_num.astype(object)
+		return loinc_num.map(df_best_before['good_before']), loinc_num.map(df_best_before['good_after'])
 	
+	def get_input_loincs(self) -> set:
+		"""
+		Get the LOINC-NUMs read by the rules (1_1, 2_1, maximal_or and filter_condition),
+		a change of any other LOINC-NUM does not change the inferred states.
+		Returns:
+			set: LOINC-NUMs
+		"""
+		return set(pd.concat([
+			self.df_map_1_1['LOINC-NUM'], self.df_map_2_1['LOINC-NUM_1'], self.df_map_2_1['LOINC-NUM_2'],
+			self.df_map_max_or['LOINC-NUM'], self.df_filter_condition['LOINC-NUM'],
+			]).astype(str))
+
 	def get_loinc_desc(self, loinc_num:str) -> str:
 		"""
 		Get the LOINC description.
@@ -91,7 +376,23 @@ class KB_Dec:
 		Returns:
 			str: LOINC description
 		"""
-		return self.df_loinc[self.df_loinc['LOINC-NUM'] == loinc_num]['LONG_COMMON_NAME'].item()
+		if self.compiled_kb is None:
+			self.compile_kb_dec()
+		if loinc_num not in self.compiled_kb['loinc_desc']:
+			raise ValueError(f'No single LOINC description of {loinc_num}')
+		return self.compiled_kb['loinc_desc'][loinc_num]
+
+	def map_loinc_desc(self, loinc_num:pd.Series) -> pd.Series:
+		"""
+		Get the LOINC descriptions of many LOINC-NUMs.
+		Args:
+			loinc_num (pd.Series): LOINC-NUM
+		Returns:
+			pd.Series: LOINC descriptions (NaN if the LOINC-NUM has no description)
+		"""
+		if self.compiled_kb is None:
+			self.compile_kb_dec()
+		return _map_lookup(loinc_num, self.compiled_kb['loinc_desc'])
 	
 	def get_full_loinc_desc(self) -> pd.DataFrame:
 		"""
@@ -117,28 +418,56 @@ class KB_Dec:
 		Returns:
 			str: state description
 		"""
-		return self.df_states[self.df_states['Therapy_Code'] == therapy_code]['Therapy_desc'].item()
+		if self.compiled_kb is None:
+			self.compile_kb_dec()
+		if therapy_code not in self.compiled_kb['states']:
+			raise ValueError(f'No single state of {therapy_code}')
+		return self.compiled_kb['states'][therapy_code]
+
+	def map_states(self, therapy_code:pd.Series) -> pd.Series:
+		"""
+		Get the states of many Therapy_Codes.
+		Args:
+			therapy_code (pd.Series): Therapy_Code
+		Returns:
+			pd.Series: state descriptions (NaN if the Therapy_Code has no state)
+		"""
+		if self.compiled_kb is None:
+			self.compile_kb_dec()
+		return _map_lookup(therapy_code, self.compiled_kb['states'])
 	
 
 class KB_Proc:
-	def __init__(self, path:typing.Union[str, bytes, os.PathLike]=None) -> None:
+	def __init__(self, path:typing.Union[str, bytes, os.PathLike]=None, use_cache:bool=True) -> None:
 		if path is not None:
-			self.load_kb_proc(path)
+			self.load_kb_proc(path, use_cache=use_cache)
 		else:
 			self.df_map_treatments = pd.DataFrame()
 			self.df_map_protocol = pd.DataFrame()
 	
-	def load_kb_proc(self, path:typing.Union[str, bytes, os.PathLike]) -> None:
+	@profiled('kb_proc.load')
+	def load_kb_proc(self, path:typing.Union[str, bytes, os.PathLike], use_cache:bool=True) -> None:
 		"""
 		Load the Procedural knowledge base.
 		Example:
 			df_map_treatments, df_map_protocol = load_kb_proc()
+		Args:
+			path: path of the spreadsheet
+			use_cache (bool): load from (and save to) the binary cache of the spreadsheet
 		Returns:
 			df_map_treatments: dataframe of treatments
 			df_map_protocol: dataframe of protocol actions
 		"""
+		cache = _read_kb_cache(path) if use_cache else None
+		if cache is not None:
+			self.__dict__.update(cache)
+			return
+
 		self.df_map_treatments = pd.read_excel(path, sheet_name='treatments')
 		self.df_map_protocol = pd.read_excel(path, sheet_name='protocol_actions')
+
+		if use_cache:
+			_write_kb_cache(path, dict(self.__dict__))
 	
 	def inference_proc(self, df_db_inf:pd.DataFrame) -> pd.Index:
 		"""
@@ -148,10 +477,34 @@ class KB_Proc:
 		Returns:
 			pd.Index: protocol codes that are inferred
 		"""
-		df_treat_inf = pd.merge(self.df_map_treatments, df_db_inf, left_on=['Therapy_Code', 'Therapy_Value'], right_on=['Therapy_Code', 'Value'], how='left')
-		df_treat_inf['bool'] = df_treat_inf['Value'].notnull()
-		df_treat_inf = df_treat_inf.groupby('protocol_code')['bool'].all()
-		df_treat_inf = df_treat_inf[df_treat_inf].index
+		df_treat_inf = self.inference_proc_batch(df_db_inf, key=None)
+		return pd.Index(df_treat_inf['protocol_code'], name='protocol_code')
+
+	@profiled('kb_proc.inference')
+	def inference_proc_batch(self, df_db_inf:pd.DataFrame, key:str='ID') -> pd.DataFrame:
+		"""
+		Perform inference on the Procedural knowledge base for all the patients at once.
+		Args:
+			df_db_inf (pd.DataFrame): dataframe after the inferred dec knowledge base (inference_dec_batch)
+			key (str): column of the patient ID, None if df_db_inf holds a single patient
+		Returns:
+			pd.DataFrame: key and protocol codes that are inferred, sorted by key and protocol code
+		"""
+		group = '_key' if key is None else key
+		df_inf = pd.DataFrame({
+			group: 0 if key is None else df_db_inf[key].to_numpy(),
+			'Therapy_Code': df_db_inf['Therapy_Code'].to_numpy(),
+			'Value': df_db_inf['Value'].to_numpy(dtype=object),
+			}, index=range(len(df_db_inf))).drop_duplicates()
+
+		df_treatments = self.df_map_treatments.rename_axis('treatment').reset_index()
+		df_treat_inf = pd.merge(df_treatments, df_inf, left_on=['Therapy_Code', 'Therapy_Value'], right_on=['Therapy_Code', 'Value'], how='inner')
+		df_treat_inf = df_treat_inf.drop_duplicates([group, 'treatment']).groupby([group, 'protocol_code']).size().reset_index(name='count')
+		df_treat_inf = df_treat_inf[df_treat_inf['count'].to_numpy() == df_treat_inf['protocol_code'].map(df_treatments.groupby('protocol_code').size()).to_numpy()]
+		df_treat_inf = df_treat_inf[[group, 'protocol_code']].reset_index(drop=True)
+
+		if key is None:
+			df_treat_inf = df_treat_inf.drop(columns=[group])
 		return df_treat_inf
 	
 	def get_protocol(self, protocol_code:pd.Index) -> pd.DataFrame:
@@ -163,15 +516,30 @@ class KB_Proc:
 			pd.DataFrame: dataframe of protocol actions
 		"""
 		return self.df_map_protocol[self.df_map_protocol['protocol_code'].isin(protocol_code)]
+
+	@profiled('kb_proc.protocol')
+	def get_protocol_batch(self, df_protocol_code:pd.DataFrame, key:str='ID') -> pd.DataFrame:
+		"""
+		Get the protocol actions of all the patients based on their protocol codes.
+		Args:
+			df_protocol_code (pd.DataFrame): key and protocol codes (inference_proc_batch)
+			key (str): column of the patient ID
+		Returns:
+			pd.DataFrame: dataframe of protocol actions indexed by key and the protocol action row
+		"""
+		df_protocol = pd.merge(df_protocol_code[[key, 'protocol_code']].drop_duplicates(), self.df_map_protocol.reset_index(), on='protocol_code', how='inner')
+		df_protocol = df_protocol.sort_values([key, 'index']).set_index([key, 'index'])
+		df_protocol.index.names = [key, None]
+		return df_protocol[self.df_map_protocol.columns]
 	
 class KB:
-	def __init__(self, path_dec:typing.Union[str, bytes, os.PathLike]=None, path_prod:typing.Union[str, bytes, os.PathLike]=None) -> None:
+	def __init__(self, path_dec:typing.Union[str, bytes, os.PathLike]=None, path_prod:typing.Union[str, bytes, os.PathLike]=None, use_cache:bool=True) -> None:
 		if path_dec is not None:
-			self.kb_dec = KB_Dec(path_dec)
+			self.kb_dec = KB_Dec(path_dec, use_cache=use_cache)
 		else:
 			self.kb_dec = KB_Dec()
 		if path_prod is not None:
-			self.kb_proc = KB_Proc(path_prod)
+			self.kb_proc = KB_Proc(path_prod, use_cache=use_cache)
 		else:
 			self.kb_proc = KB_Proc()
 	
@@ -187,3 +555,32 @@ class KB:
 		protocol_code = self.kb_proc.inference_proc(df_db_inf)
 		df_protocol = self.kb_proc.get_protocol(protocol_code)
 		return df_protocol
+
+	def inference_protocol_batch(self, df_db:pd.DataFrame, key:str='ID') -> pd.DataFrame:
+		"""
+		Perform inference on the knowledge base for all the patients at once.
+		Same result as df_db.groupby(key).apply(inference_protocol).
+		Args:
+			df_db (pd.DataFrame): dataframe of the database
+			key (str): column of the patient ID
+		Returns:
+			pd.DataFrame: dataframe of the inferred protocol actions indexed by key
+		"""
+		_, df_protocol = self.inference_batch(df_db, key=key)
+		return df_protocol
+
+	@profiled('kb.inference')
+	def inference_batch(self, df_db:pd.DataFrame, key:str='ID') -> (pd.DataFrame, pd.DataFrame):
+		"""
+		Perform inference on the knowledge base for all the patients at once.
+		Args:
+			df_db (pd.DataFrame): dataframe of the database
+			key (str): column of the patient ID
+		Returns:
+			pd.DataFrame: dataframe of the inferred states (inference_dec_batch)
+			pd.DataFrame: dataframe of the inferred protocol actions indexed by key (inference_protocol_batch)
+		"""
+		df_db_inf = self.kb_dec.inference_dec_batch(df_db, key=key)
+		df_protocol_code = self.kb_proc.inference_proc_batch(df_db_inf, key=key)
+		df_protocol = self.kb_proc.get_protocol_batch(df_protocol_code, key=key)
+		return df_db_inf, df_protocol
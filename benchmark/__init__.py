@@ -0,0 +1,6 @@
+"""
+Synthetic bitemporal databases and timed scenarios of the engine.
+    python -m benchmark --patients 1000 --observations 50 --output report.json
+"""
+from benchmark.generator import generate_db
+from benchmark.scenarios import run_benchmarks
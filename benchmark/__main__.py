@@ -0,0 +1,58 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import pandas as pd
+from KnowledgeBase import KB_Dec
+from benchmark.generator import generate_db
+from benchmark.scenarios import run_benchmarks
+
+
+def _units(path):
+    # LOINC-NUM -> Unit of a sample database (the knowledge base has no units)
+    if path is None or not os.path.exists(path):
+        return {}
+    db = pd.read_csv(path, usecols=['LOINC-NUM', 'Unit'])
+    return dict(db.drop_duplicates('LOINC-NUM').itertuples(index=False, name=None))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmark', description='Benchmark the DSS engine over a synthetic database.')
+    parser.add_argument('--patients', type=int, default=100, help='number of patients')
+    parser.add_argument('--observations', type=int, default=50, help='observations of every patient')
+    parser.add_argument('--corrections', type=int, default=10, help='corrections of every patient')
+    parser.add_argument('--deletions', type=int, default=5, help='deletions of every patient')
+    parser.add_argument('--queries', type=int, default=100, help='calls of every query scenario')
+    parser.add_argument('--workers', type=int, default=None, help='workers of the parallel inference')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--kb-dec', default='kb_dec.xlsx')
+    parser.add_argument('--kb-proc', default='kb_proc.xlsx')
+    parser.add_argument('--units-from', default='project_db_updated.csv', help='sample database of the units')
+    parser.add_argument('--save-db', default=None, help='also write the generated database to this csv')
+    parser.add_argument('--output', default=None, help='json report path (stdout if missing)')
+    args = parser.parse_args(argv)
+
+    db = generate_db(KB_Dec(args.kb_dec), n_patients=args.patients, n_observations=args.observations,
+                     n_corrections=args.corrections, n_deletions=args.deletions,
+                     units=_units(args.units_from), seed=args.seed)
+    if args.save_db:
+        db.to_csv(args.save_db, index=False, date_format='%d/%m/%Y %H:%M')
+
+    report = {
+        'config': vars(args),
+        'environment': {'python': sys.version.split()[0], 'pandas': pd.__version__,
+                        'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'data': {'rows': len(db), 'patients': int(db['ID'].nunique()), 'loincs': int(db['LOINC-NUM'].nunique())},
+        'results': run_benchmarks(db, args.kb_dec, args.kb_proc, n_queries=args.queries, workers=args.workers, seed=args.seed),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
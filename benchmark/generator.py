@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+from schema import COLUMNS
+
+NAME_SYLLABLES = ['av', 'ra', 'ham', 'ben', 'ja', 'min', 'yo', 'na', 'than', 'e', 'ri', 'ca', 'da', 'vid', 'sa', 'rah', 'le', 'ah']
+
+
+def _numeric_ranges(kb_dec):
+    # LOINC-NUM -> (low, top) covering all the numeric rules of the knowledge base
+    bounds = [(kb_dec.df_map_1_1['LOINC-NUM'], kb_dec.df_map_1_1['scale_low'], kb_dec.df_map_1_1['scale_top']),
+              (kb_dec.df_map_2_1['LOINC-NUM_1'], kb_dec.df_map_2_1['scale_low_1'], kb_dec.df_map_2_1['scale_top_1']),
+              (kb_dec.df_map_2_1['LOINC-NUM_2'], kb_dec.df_map_2_1['scale_low_2'], kb_dec.df_map_2_1['scale_top_2']),
+              (kb_dec.df_map_max_or['LOINC-NUM'], kb_dec.df_map_max_or['scale_low'], kb_dec.df_map_max_or['scale_top'])]
+    df = pd.concat([pd.DataFrame({'LOINC-NUM': loinc.astype(str).to_numpy(),
+                                  'low': pd.to_numeric(low, errors='coerce').to_numpy(dtype=float),
+                                  'top': pd.to_numeric(top, errors='coerce').to_numpy(dtype=float)})
+                    for loinc, low, top in bounds]).dropna()
+    ranges = {}
+    for loinc, group in df.groupby('LOINC-NUM'):
+        low = group['low'].min()
+        finite = np.concatenate([group['low'].to_numpy(), group['top'].to_numpy()])
+        top = finite[np.isfinite(finite)].max()
+        ranges[loinc] = (low, top * 1.25 if top > low else low + 1)  # a bit above the last finite bound (inf rules)
+    return ranges
+
+
+def _text_values(kb_dec):
+    # LOINC-NUM -> text values of the maximal_or rules (scale_low == scale_top)
+    df = kb_dec.df_map_max_or
+    df = df[pd.to_numeric(df['scale_low'], errors='coerce').isna() & (df['scale_low'] == df['scale_top'])]
+    return {loinc: list(pd.unique(group['scale_low'])) for loinc, group in df.groupby(df['LOINC-NUM'].astype(str))}
+
+
+def generate_db(kb_dec, n_patients=100, n_observations=50, n_corrections=10, n_deletions=5,
+                start='2018-05-01', days=30, units=None, seed=0):
+    """
+    Generate a synthetic bitemporal database with the LOINC-NUMs and value ranges of the knowledge base.
+    Args:
+        kb_dec (KB_Dec): declarative knowledge base
+        n_patients (int): number of patients
+        n_observations (int): observations of every patient (plus its Gender row)
+        n_corrections (int): corrections of every patient (new rows of an existing observation, as update does)
+        n_deletions (int): deletions of every patient ('Transaction stop time' of an observation, as delete does)
+        start: first valid time
+        days (int): number of days of the valid times
+        units (dict): LOINC-NUM -> Unit ('none' for the missing LOINC-NUMs)
+        seed (int): seed of the random generator
+    Returns:
+        pd.DataFrame: the database
+    """
+    rng = np.random.default_rng(seed)
+    units = {} if units is None else units
+    ranges = _numeric_ranges(kb_dec)
+    texts = _text_values(kb_dec)
+    loincs = sorted(set(ranges) | set(texts))
+    genders = sorted(set(kb_dec.df_filter_condition.loc[kb_dec.df_filter_condition['LOINC-NUM'] == 'Gender', 'Value']))
+    start = pd.Timestamp(start)
+
+    ids = np.arange(1, n_patients + 1)
+    first_names = [''.join(rng.choice(NAME_SYLLABLES, 3)).capitalize() + str(i) for i in ids]
+    last_names = [''.join(rng.choice(NAME_SYLLABLES, 2)).capitalize() for _ in ids]
+
+    # observations
+    patient = np.repeat(np.arange(n_patients), n_observations)
+    loinc = np.array(loincs, dtype=object)[rng.integers(len(loincs), size=len(patient))]
+    valid = start + pd.to_timedelta(rng.integers(days * 24 * 60, size=len(patient)), unit='min')
+    trans = valid + pd.to_timedelta(rng.integers(0, 6 * 60, size=len(patient)), unit='min')  # reported after a delay
+    value = np.empty(len(patient), dtype=object)
+    for code in loincs:
+        mask = loinc == code
+        if code in ranges:
+            low, top = ranges[code]
+            value[mask] = np.round(rng.uniform(low, top, size=mask.sum()), 1)
+        else:
+            value[mask] = np.array(texts[code], dtype=object)[rng.integers(len(texts[code]), size=mask.sum())]
+    observations = pd.DataFrame({'patient': patient, 'LOINC-NUM': loinc, 'Value': value,
+                                 'Transaction time': trans, 'Valid start time': valid})
+
+    # Gender rows, valid long before the observations
+    gender = pd.DataFrame({'patient': np.arange(n_patients), 'LOINC-NUM': 'Gender',
+                           'Value': np.array(genders, dtype=object)[rng.integers(len(genders), size=n_patients)],
+                           'Transaction time': start - pd.Timedelta(days=365), 'Valid start time': start - pd.Timedelta(days=365)})
+
+    # corrections: same observation (valid time), new value, later transaction time
+    corrected = observations.iloc[rng.choice(len(observations), size=min(n_patients * n_corrections, len(observations)), replace=False)].copy()
+    corrected['Transaction time'] = corrected['Transaction time'] + pd.to_timedelta(rng.integers(1, 3 * 24 * 60, size=len(corrected)), unit='min')
+    corrected = corrected[corrected['LOINC-NUM'].map(lambda code: code in ranges).to_numpy()]  # numeric corrections only
+    corrected['Value'] = [np.round(rng.uniform(*ranges[code]), 1) for code in corrected['LOINC-NUM']]
+
+    db = pd.concat([observations, corrected, gender], ignore_index=True)
+    db['Valid stop time'] = pd.NaT
+    db['Transaction stop time'] = pd.NaT
+
+    # deletions: 'Transaction stop time' after the transaction time
+    deleted = rng.choice(len(observations), size=min(n_patients * n_deletions, len(observations)), replace=False)
+    db.loc[deleted, 'Transaction stop time'] = (db.loc[deleted, 'Transaction time']
+                                                + pd.to_timedelta(rng.integers(1, 3 * 24 * 60, size=len(deleted)), unit='min')).to_numpy()
+
+    db = db.sort_values(['patient', 'LOINC-NUM', 'Valid start time', 'Transaction time'], kind='stable').reset_index(drop=True)
+    db['ID'] = ids[db['patient']]
+    db['First name'] = np.array(first_names, dtype=object)[db['patient']]
+    db['Last name'] = np.array(last_names, dtype=object)[db['patient']]
+    db['Unit'] = db['LOINC-NUM'].map(lambda code: units.get(code, 'none'))
+    return db[COLUMNS]
@@ -0,0 +1,109 @@
+import time
+import numpy as np
+import pandas as pd
+from KnowledgeBase import KB
+from dss_engine import DSS_Engine, StateCache
+
+
+def _stats(seconds):
+    seconds = np.asarray(seconds)
+    return {'count': int(len(seconds)), 'total': float(seconds.sum()), 'mean': float(seconds.mean()),
+            'p50': float(np.percentile(seconds, 50)), 'p95': float(np.percentile(seconds, 95)),
+            'min': float(seconds.min()), 'max': float(seconds.max())}
+
+
+def _timed(calls):
+    # seconds of every call
+    seconds = []
+    for call in calls:
+        start = time.perf_counter()
+        call()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def _date(timestamp):
+    return timestamp.strftime('%Y-%m-%d')
+
+
+def _time(timestamp):
+    return timestamp.strftime('%H:%M')
+
+
+def _queries(db, n_queries, seed):
+    # observations of the db (with the Transaction time of the query after them), the Gender rows excluded
+    observations = db[db['LOINC-NUM'] != 'Gender']
+    return observations.sample(n_queries, replace=len(observations) < n_queries, random_state=seed)
+
+
+def run_benchmarks(db, kb_dec_path='kb_dec.xlsx', kb_proc_path='kb_proc.xlsx', n_queries=100, workers=None, seed=0):
+    """
+    Time the scenarios of the engine over a database.
+    Args:
+        db (pd.DataFrame): the database (such as generate_db)
+        kb_dec_path: path of the declarative knowledge base
+        kb_proc_path: path of the procedural knowledge base
+        n_queries (int): number of calls of every query scenario
+        workers (int): workers of the parallel inference, None for the serial inference
+        seed (int): seed of the sampled queries
+    Returns:
+        dict: scenario -> statistics of the seconds of its calls (count, total, mean, p50, p95, min, max)
+    """
+    results = {}
+    results['kb_load'] = _stats(_timed([lambda: KB(kb_dec_path, kb_proc_path, use_cache=False)]))
+    KB(kb_dec_path, kb_proc_path)  # write the cache
+    results['kb_load_cached'] = _stats(_timed([lambda: KB(kb_dec_path, kb_proc_path)] * 3))
+    kb = KB(kb_dec_path, kb_proc_path)
+
+    engines = []
+    results['engine_init'] = _stats(_timed([lambda: engines.append(DSS_Engine(db=db.copy(), kb=kb, workers=workers))]))
+    dss = engines[0]
+
+    queries = _queries(db, n_queries, seed)
+    later = pd.Timedelta(days=1)
+    rows = list(queries.itertuples(index=False, name=None))
+    columns = {column: i for i, column in enumerate(queries.columns)}
+
+    def row_args(row):
+        valid, trans = row[columns['Valid start time']], row[columns['Transaction time']] + later
+        return row[columns['LOINC-NUM']], row[columns['First name']], row[columns['Last name']], valid, trans
+
+    def retrieval(row):
+        loinc, first_name, last_name, valid, trans = row_args(row)
+        return lambda: dss.retrieval(loinc, first_name, last_name, _date(trans), _time(trans), _date(valid), _time(valid))
+
+    def history(row):
+        loinc, first_name, last_name, valid, trans = row_args(row)
+        start = valid - pd.Timedelta(days=7)
+        return lambda: dss.history_retrival(loinc, first_name, last_name, _date(start), _time(start), _date(valid),
+                                            _date(trans), trans_time=_time(trans))
+
+    def update(row):
+        loinc, first_name, last_name, valid, trans = row_args(row)
+        value = row[columns['Value']]
+        return lambda: dss.update(loinc, first_name, last_name, _date(trans), _time(trans), _date(valid), _time(valid), value)
+
+    def delete(row):
+        loinc, first_name, last_name, valid, trans = row_args(row)
+        return lambda: dss.delete(loinc, first_name, last_name, _date(trans + later), _time(trans), _date(valid), _time(valid))
+
+    results['retrieval'] = _stats(_timed([retrieval(row) for row in rows]))
+    results['history_retrival'] = _stats(_timed([history(row) for row in rows]))
+
+    # the states at the last transaction time of the db
+    at = db['Transaction time'].max() + later
+    at_date, at_time = _date(at), _time(at)
+    results['get_patient_data'] = _stats(_timed([lambda: dss.get_patient_data(at_date, at_time)] * 3))
+    def cold_states():
+        dss.state_cache = StateCache()  # drop the cached inference
+        return dss.get_states(at_date, at_time)
+
+    results['get_states_cold'] = _stats(_timed([cold_states] * 3))
+    results['get_states_warm'] = _stats(_timed([lambda: dss.get_states(at_date, at_time)] * n_queries))
+
+    # writes, then the incremental refresh of the states of the changed patients
+    results['update'] = _stats(_timed([update(row) for row in rows]))
+    results['delete'] = _stats(_timed([delete(row) for row in rows]))
+    results['get_states_after_writes'] = _stats(_timed([lambda: dss.get_states(at_date, at_time)]))
+    dss.close()
+    return results
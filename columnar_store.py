@@ -0,0 +1,299 @@
+import json
+import os
+import uuid
+import numpy as np
+import pandas as pd
+from schema import COLUMNS
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # optional, only needed for the parquet storage mode
+    pa = None
+
+
+def _timestamp(value):
+    return pa.scalar(pd.Timestamp(value).value, type=pa.timestamp('ns'))
+
+
+class ParquetStore:
+    """
+    Parquet dataset of the database, partitioned by patient ID (hive layout: <path>/ID=<id>/*.parquet).
+    The rows of a partition are sorted by LOINC-NUM and 'Valid start time', so the row group
+    statistics let the reader skip what a query does not need. Every row keeps its database
+    label in the '_row' column. _meta.json holds the next free label and the patient names.
+    An append adds a small file to every touched partition, a partition with more than max_files files
+    is compacted back into a single sorted file.
+    """
+    def __init__(self, path, row_group_size=65536, max_files=8):
+        if pa is None:
+            raise ImportError('ParquetStore requires pyarrow (pip install pyarrow)')
+        self.path = path
+        self.row_group_size = row_group_size
+        self.max_files = max_files
+        self.schema = pa.schema([
+            ('_row', pa.int64()),
+            ('First name', pa.string()),
+            ('Last name', pa.string()),
+            ('LOINC-NUM', pa.string()),
+            ('Value', pa.string()),
+            ('Unit', pa.string()),
+            ('Transaction time', pa.timestamp('ns')),
+            ('Valid start time', pa.timestamp('ns')),
+            ('Valid stop time', pa.timestamp('ns')),
+            ('Transaction stop time', pa.timestamp('ns')),
+            ])
+        self.partitioning = ds.partitioning(pa.schema([('ID', pa.int64())]), flavor='hive')
+        self.meta = self._read_meta()
+
+    def _meta_path(self):
+        return os.path.join(self.path, '_meta.json')
+
+    def _read_meta(self):
+        if not os.path.exists(self._meta_path()):
+            return {'next_row': 0, 'patients': []}
+        with open(self._meta_path()) as f:
+            return json.load(f)
+
+    def _write_meta(self):
+        with open(self._meta_path() + '.tmp', 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(self._meta_path() + '.tmp', self._meta_path())
+
+    def _partition_path(self, patient_id):
+        return os.path.join(self.path, f'ID={int(patient_id)}')
+
+    def _partition_files(self, patient_id):
+        path = self._partition_path(patient_id)
+        if not os.path.isdir(path):
+            return []
+        return [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.parquet')]
+
+    def _dataset(self, patient_ids=None):
+        # the dataset of some partitions (only their files are listed), or of the whole store
+        schema = self.schema.append(pa.field('ID', pa.int64()))
+        if patient_ids is None:
+            return ds.dataset(self.path, format='parquet', partitioning=self.partitioning, schema=schema)
+        files = [name for patient_id in sorted(set(patient_ids)) for name in self._partition_files(patient_id)]
+        if not files:
+            return None
+        return ds.dataset(files, format='parquet', partitioning=self.partitioning, schema=schema, partition_base_dir=self.path)
+
+    def _to_table(self, df):
+        df = df.sort_values(['LOINC-NUM', 'Valid start time'], kind='stable').copy()
+        df['_row'] = df.index
+        df['Value'] = df['Value'].map(lambda value: None if pd.isnull(value) else str(value))
+        return pa.Table.from_pandas(df[self.schema.names], schema=self.schema, preserve_index=False)
+
+    def _write_partition(self, patient_id, df):
+        # replace all the files of the partition by a single sorted file
+        path = self._partition_path(patient_id)
+        os.makedirs(path, exist_ok=True)
+        old_files = [name for name in os.listdir(path) if name.endswith('.parquet')]
+        pq.write_table(self._to_table(df), os.path.join(path, '.part.tmp'), row_group_size=self.row_group_size)
+        os.replace(os.path.join(path, '.part.tmp'), os.path.join(path, 'part-0.parquet'))
+        for name in old_files:
+            if name != 'part-0.parquet':
+                os.remove(os.path.join(path, name))
+
+    def write(self, db):
+        """
+        Write the whole database into the store.
+        Args:
+            db (pd.DataFrame): the database, its index is kept as the row labels
+        """
+        os.makedirs(self.path, exist_ok=True)
+        for patient_id, df in db.groupby('ID'):
+            self._write_partition(patient_id, df)
+        self.meta = {
+            'next_row': int(db.index.max()) + 1 if len(db) else 0,
+            'patients': db[['ID', 'First name', 'Last name']].drop_duplicates().values.tolist(),
+            }
+        self._write_meta()
+
+    def patients(self):
+        """
+        Returns:
+            pd.DataFrame: ID, First name and Last name of the patients
+        """
+        return pd.DataFrame(self.meta['patients'], columns=['ID', 'First name', 'Last name'])
+
+    def patient_ids(self, first_name, last_name):
+        return [int(patient_id) for patient_id, first, last in self.meta['patients'] if (first, last) == (first_name, last_name)]
+
+    def read(self, first_name=None, last_name=None, patient_id=None, loinc=None,
+             valid_from=None, valid_to=None, trans_to=None, alive_at=None, columns=None, patient_ids=None, loincs=None):
+        """
+        Read the rows of the store, the filters are pushed down to the parquet reader.
+        Args:
+            first_name, last_name: patient name
+            patient_id: patient ID
+            loinc: LOINC-NUM
+            patient_ids: list of patient IDs, the rows of any of them
+            loincs: list of LOINC-NUMs, the rows of any of them
+            valid_from: first 'Valid start time' (inclusive)
+            valid_to: last 'Valid start time' (exclusive)
+            trans_to: last 'Transaction time' (inclusive)
+            alive_at: keep only the rows that are not deleted at this time
+            columns: columns to read, None for all
+        Returns:
+            pd.DataFrame: rows indexed by their labels, in the database order
+        """
+        columns = COLUMNS if columns is None else columns
+        if not os.path.isdir(self.path):
+            return pd.DataFrame(columns=columns)
+        partitions, condition = self._filters(first_name, last_name, patient_id, loinc, valid_from, valid_to, trans_to,
+                                              alive_at, patient_ids, loincs)
+        return self._read(partitions, condition, columns)
+
+    def iter_read(self, chunksize=100000, by_key=False, **filters):
+        """
+        Read the rows of the store chunk by chunk instead of all the rows at once.
+        In the database order, the labels of the rows are scanned first (only the _row column)
+        and then every chunk of labels is read. Sorted by key, the partitions are read one at a time.
+        Args:
+            chunksize (int): number of rows of every chunk (of every partition with by_key)
+            by_key (bool): sort the rows by ID, LOINC-NUM, 'Valid start time', 'Transaction time' (and label)
+                instead of the database order
+            filters: the filters of read
+        Yields:
+            pd.DataFrame: the next rows, indexed by their labels
+        """
+        if not os.path.isdir(self.path):
+            return
+        partitions, condition = self._filters(**filters)
+        if by_key:
+            for patient_id in self._partition_ids() if partitions is None else sorted(partitions):
+                df = self._read([patient_id], condition, COLUMNS)
+                df = df.sort_values(['LOINC-NUM', 'Valid start time', 'Transaction time'], kind='stable')
+                for start in range(0, len(df), chunksize):
+                    yield df.iloc[start:start + chunksize]
+            return
+        dataset = self._dataset(partitions)
+        if dataset is None:
+            return
+        labels = [batch.column(0).to_numpy() for batch in dataset.to_batches(columns=['_row'], filter=condition)]
+        labels = np.sort(np.concatenate(labels)) if labels else np.array([], dtype=np.int64)
+        for start in range(0, len(labels), chunksize):
+            chunk = pc.field('_row').isin(pa.array(labels[start:start + chunksize]))
+            yield self._read(partitions, chunk if condition is None else condition & chunk, COLUMNS)
+
+    def _partition_ids(self):
+        return sorted({int(patient[0]) for patient in self.meta['patients']})
+
+    def _filters(self, first_name=None, last_name=None, patient_id=None, loinc=None,
+                 valid_from=None, valid_to=None, trans_to=None, alive_at=None, patient_ids=None, loincs=None):
+        # IDs of the partitions to read (None for all) and the pushed down filter of read
+        conditions = []
+        partitions = None  # IDs of the partitions to read, None for all
+        if first_name is not None or last_name is not None:
+            partitions = self.patient_ids(first_name, last_name)
+            conditions.append((pc.field('First name') == first_name) & (pc.field('Last name') == last_name))
+        if patient_id is not None:
+            partitions = [int(patient_id)] if partitions is None else [value for value in partitions if value == int(patient_id)]
+        if patient_ids is not None:
+            patient_ids = {int(value) for value in patient_ids}
+            partitions = sorted(patient_ids) if partitions is None else [value for value in partitions if value in patient_ids]
+        if loinc is not None:
+            conditions.append(pc.field('LOINC-NUM') == loinc)
+        if loincs is not None:
+            conditions.append(pc.field('LOINC-NUM').isin(list(loincs)))
+        if valid_from is not None:
+            conditions.append(pc.field('Valid start time') >= _timestamp(valid_from))
+        if valid_to is not None:
+            conditions.append(pc.field('Valid start time') < _timestamp(valid_to))
+        if trans_to is not None:
+            conditions.append(pc.field('Transaction time') <= _timestamp(trans_to))
+        if alive_at is not None:
+            conditions.append(pc.field('Transaction stop time').is_null() | (pc.field('Transaction stop time') > _timestamp(alive_at)))
+        condition = None
+        for c in conditions:
+            condition = c if condition is None else condition & c
+        return partitions, condition
+
+    def _read(self, partitions, condition, columns):
+        dataset = self._dataset(partitions)
+        if dataset is None:
+            table = self.schema.append(pa.field('ID', pa.int64())).empty_table().select(['_row'] + columns)
+        else:
+            table = dataset.to_table(columns=['_row'] + columns, filter=condition)
+        df = table.to_pandas()
+        df = df.set_index('_row').sort_index()
+        df.index.name = None
+        return df
+
+    def snapshot(self, at):
+        """
+        Get the latest row of every (ID, LOINC-NUM) known and not deleted at a transaction time.
+        Args:
+            at: transaction time
+        Returns:
+            pd.DataFrame: rows sorted by ID and LOINC-NUM
+        """
+        return self._latest(self.read(trans_to=at, alive_at=at))
+
+    def iter_snapshot(self, at, chunksize=100000):
+        """
+        Same as snapshot, one partition at a time.
+        Yields:
+            pd.DataFrame: the next rows of the snapshot (at most chunksize rows)
+        """
+        for patient_id in self._partition_ids():
+            df = self._latest(self.read(patient_id=patient_id, trans_to=at, alive_at=at))
+            for start in range(0, len(df), chunksize):
+                yield df.iloc[start:start + chunksize]
+
+    @staticmethod
+    def _latest(df):
+        # the latest row of every (ID, LOINC-NUM)
+        df = df.sort_values(['ID', 'LOINC-NUM', 'Valid start time', 'Transaction time'],
+                            ascending=[True, True, False, False], kind='stable')
+        return df.drop_duplicates(['ID', 'LOINC-NUM'], keep='first')
+
+    def append(self, rows):
+        """
+        Add new rows to the store, as one small file in the partition of every patient
+        (a partition with more than max_files files is compacted).
+        Args:
+            rows (pd.DataFrame): the new rows
+        Returns:
+            np.ndarray: labels of the new rows
+        """
+        labels = np.arange(self.meta['next_row'], self.meta['next_row'] + len(rows))
+        rows = rows.set_axis(labels)
+        for patient_id, df in rows.groupby('ID'):
+            path = self._partition_path(patient_id)
+            os.makedirs(path, exist_ok=True)
+            pq.write_table(self._to_table(df), os.path.join(path, f'part-{uuid.uuid4().hex}.parquet'))
+            if len(self._partition_files(patient_id)) > self.max_files:
+                self._write_partition(patient_id, self.read(patient_id=patient_id))
+        patients = {tuple(patient) for patient in self.meta['patients']}
+        self.meta['patients'] += [patient for patient in rows[['ID', 'First name', 'Last name']].drop_duplicates().values.tolist()
+                                  if tuple(patient) not in patients]
+        self.meta['next_row'] = int(labels[-1]) + 1 if len(labels) else self.meta['next_row']
+        self._write_meta()
+        return labels
+
+    def set_stop(self, label, patient_id, stop_time):
+        """
+        Set the 'Transaction stop time' of a row, the partition of the patient is rewritten.
+        """
+        df = self.read(patient_id=patient_id)
+        df.loc[label, 'Transaction stop time'] = pd.Timestamp(stop_time)
+        self._write_partition(patient_id, df)
+
+    def set_stops(self, labels, patient_ids, stop_times):
+        """
+        Set the 'Transaction stop time' of many rows, every touched partition is rewritten once.
+        Args:
+            labels: labels of the rows
+            patient_ids: IDs of the patients of the rows
+            stop_times: new 'Transaction stop time' of every row
+        """
+        stops = pd.DataFrame({'label': labels, 'ID': patient_ids, 'time': pd.to_datetime(stop_times)})
+        for patient_id, group in stops.groupby('ID', sort=False):
+            df = self.read(patient_id=patient_id)
+            df.loc[group['label'].to_numpy(), 'Transaction stop time'] = group['time'].to_numpy()
+            self._write_partition(patient_id, df)
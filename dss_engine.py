@@ -1,85 +1,573 @@
+import datetime
+import functools
+import threading
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
 from KnowledgeBase import KB
+from observation_table import ObservationTable
+from patient_registry import PatientRegistry
+from parallel_inference import ParallelInference
+from profiling import profiler, profiled
+from schema import COLUMNS, DATE_COLUMNS
 
 
-class DSS_Engine:
+def _to_ns(times):
+    """
+    Convert timestamps to int64 nanoseconds (NaT is the minimal int64).
+    """
+    return pd.to_datetime(pd.Series(times)).to_numpy(dtype='datetime64[ns]').view('int64')
+
+
+def _ns(time):
+    """
+    Convert one timestamp to int64 nanoseconds (NaT is the minimal int64).
+    """
+    return pd.Timestamp(time).value
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_datetime(text):
+    # the UI asks again and again for the same few date strings
+    return pd.to_datetime(text)
+
+
+def _to_datetime(date, time=None):
+    """
+    Timestamp of a date and a time of the day, the arguments of the engine methods.
+    Args:
+        date: str (such as '2018-5-22'), datetime.date, datetime.datetime or pd.Timestamp
+        time: str (such as '11:30'), datetime.time, or None for the time of the date
+    Returns:
+        pd.Timestamp: the timestamp (strings are parsed once and then cached)
+    """
+    if isinstance(date, str):
+        return _parse_datetime(date if time is None else f'{date} {time}')
+    date = pd.Timestamp(date)
+    if time is None:
+        return date
+    if isinstance(time, str):
+        return _parse_datetime(f'{date.date()} {time}')
+    return pd.Timestamp(datetime.datetime.combine(date.date(), time))
+
+
+def _day_range(date):
+    """
+    Returns:
+        (pd.Timestamp, pd.Timestamp): start of the day of a date and start of the next day, the day is [day_start, day_end)
+    """
+    day_start = _to_datetime(date).normalize()
+    return day_start, day_start + pd.Timedelta(days=1)
+
+
+def _alive(data, at):
+    # rows not deleted at a transaction time ('Transaction stop time' missing or after it), compared as int64
+    stop = data['Transaction stop time'].to_numpy(dtype='datetime64[ns]').view('int64')
+    return data[(stop == BitemporalIndex.NAT) | (stop > at.value)]
+
+
+def read_observations(source, format='csv', chunksize=1000):
+    """
+    Read new observations in chunks, for DSS_Engine.ingest_stream.
+    Args:
+        source: path or file object (a pipe such as sys.stdin works too)
+        format (str): 'csv' or 'ndjson' (one JSON object per line)
+        chunksize (int): number of rows of every chunk
+    Returns:
+        iterator of pd.DataFrame
+    """
+    if format == 'csv':
+        return pd.read_csv(source, chunksize=chunksize)
+    if format == 'ndjson':
+        return pd.read_json(source, lines=True, chunksize=chunksize, convert_dates=False)
+    raise ValueError(f'Unknown format: {format}')
+
+
+def _rechunk(frames, chunksize):
+    # regroup frames of any length into chunks of chunksize rows (the last one may be shorter)
+    buffer, size = [], 0
+    for frame in frames:
+        if len(frame) == 0:
+            continue
+        buffer.append(frame)
+        size += len(frame)
+        while size >= chunksize:
+            data = pd.concat(buffer) if len(buffer) > 1 else buffer[0]
+            yield data.iloc[:chunksize]
+            rest = data.iloc[chunksize:]
+            buffer, size = ([rest] if len(rest) else []), len(rest)
+    if buffer:
+        yield pd.concat(buffer) if len(buffer) > 1 else buffer[0]
+
+
+def write_chunks(chunks, path, format='csv'):
+    """
+    Write the chunks of a query (such as iter_patient_data) to a file one chunk at a time, for large exports.
+    Args:
+        chunks: iterable of pd.DataFrame with the same columns
+        path: path of the file
+        format (str): 'csv' or 'parquet' (needs pyarrow, Value is written as text)
+    Returns:
+        int: number of written rows
+    """
+    if format not in ('csv', 'parquet'):
+        raise ValueError(f'Unknown format: {format}')
+    n_rows = 0
+    writer = None
+    try:
+        for chunk in chunks:
+            if format == 'csv':
+                chunk.to_csv(path, mode='w' if writer is None else 'a', header=writer is None, index=False)
+                writer = path
+            else:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                chunk = chunk.assign(Value=chunk['Value'].map(lambda value: None if pd.isnull(value) else str(value)))
+                table = pa.Table.from_pandas(chunk, preserve_index=False, schema=None if writer is None else writer.schema)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+            n_rows += len(chunk)
+    finally:
+        if writer is not None and format == 'parquet':
+            writer.close()
+    return n_rows
+
+
+class BitemporalIndex:
+    """
+    Index of the database rows by (First name, Last name, LOINC-NUM).
+    The rows of every key are sorted by 'Valid start time' and then by 'Transaction time',
+    so the queries of a patient and a LOINC-NUM are binary searches instead of full scans.
+    """
+    NAT = np.iinfo(np.int64).min
+
     def __init__(self, db):
-        self.db = db
+        self.groups = {}
+        if len(db) == 0:
+            return
+        valid = _to_ns(db['Valid start time'])
+        trans = _to_ns(db['Transaction time'])
+        order = np.lexsort((trans, valid))
+        labels = db.index.to_numpy()[order]
+        keys = db[['First name', 'Last name', 'LOINC-NUM']].iloc[order]
+        for key, positions in keys.groupby(['First name', 'Last name', 'LOINC-NUM'], sort=False, dropna=False, observed=True).indices.items():
+            self.groups[key] = (labels[positions], valid[order][positions], trans[order][positions])
+
+    def insert(self, label, first_name, last_name, loinc, valid_start_time, transaction_time):
+        """
+        Add a new row of the database to the index.
+        """
+        valid_ns = _ns(valid_start_time)
+        trans_ns = _ns(transaction_time)
+        labels, valid, trans = self.groups.get((first_name, last_name, loinc), (np.array([], dtype=np.int64),) * 3)
+        lo = np.searchsorted(valid, valid_ns, side='left')
+        hi = np.searchsorted(valid, valid_ns, side='right')
+        pos = lo + np.searchsorted(trans[lo:hi], trans_ns, side='right')
+        self.groups[(first_name, last_name, loinc)] = (np.insert(labels, pos, label), np.insert(valid, pos, valid_ns), np.insert(trans, pos, trans_ns))
+
+    def insert_many(self, labels, rows):
+        """
+        Add new rows of the database to the index.
+        Args:
+            labels (np.ndarray): labels of the rows
+            rows (pd.DataFrame): the rows
+        """
+        valid = _to_ns(rows['Valid start time'])
+        trans = _to_ns(rows['Transaction time'])
+        keys = rows[['First name', 'Last name', 'LOINC-NUM']]
+        for key, positions in keys.groupby(['First name', 'Last name', 'LOINC-NUM'], sort=False, dropna=False, observed=True).indices.items():
+            old = self.groups.get(key, (np.array([], dtype=np.int64),) * 3)
+            group = [np.concatenate([old[0], labels[positions]]),
+                     np.concatenate([old[1], valid[positions]]),
+                     np.concatenate([old[2], trans[positions]])]
+            order = np.lexsort((group[2], group[1]))
+            self.groups[key] = tuple(values[order] for values in group)
+
+    def search(self, first_name, last_name, loinc, valid_from=None, valid_to=None, trans_to=None):
+        """
+        Find the rows of a patient and a LOINC-NUM.
+        Args:
+            valid_from: first 'Valid start time' (inclusive)
+            valid_to: last 'Valid start time' (exclusive)
+            trans_to: last 'Transaction time' (inclusive)
+        Returns:
+            np.ndarray: labels of the rows in the database order
+        """
+        labels, valid, trans = self.groups.get((first_name, last_name, loinc), (np.array([], dtype=np.int64),) * 3)
+        lo = 0 if valid_from is None else np.searchsorted(valid, _ns(valid_from), side='left')
+        hi = len(valid) if valid_to is None else np.searchsorted(valid, _ns(valid_to), side='left')
+        labels, valid, trans = labels[lo:hi], valid[lo:hi], trans[lo:hi]
+        mask = valid != self.NAT
+        if trans_to is not None:
+            mask &= (trans != self.NAT) & (trans <= _ns(trans_to))
+        return np.sort(labels[mask])
+
+
+class StateCache:
+    """
+    Inferred states and protocol actions of all the patients at one transaction time.
+    update/delete mark the changed patient as outdated and only the outdated patients are inferred again.
+    A change of a LOINC-NUM that the rules do not read, or a change after the cached transaction time,
+    does not outdate anything.
+    """
+    def __init__(self):
+        self.kb = None
+        self.at = None
+        self.input_loincs = set()
+        self.states = None  # inference_dec_batch result (ID, Therapy_Code, Value)
+        self.protocols = None  # inference_protocol_batch result indexed by ID
+        self.outdated = set()
+        self.refreshing = 0  # number of full inferences reading the db, every change during the read is kept
+
+    def is_valid(self, kb, at):
+        return self.kb is kb and self.at == at
+
+    def reset(self, kb, at, states, protocols, patient_ids=()):
+        """
+        Replace the whole cache by a new inference of all the patients.
+        Args:
+            patient_ids: the outdated patients read by the inference, the patients outdated since then stay outdated
+        """
+        self.kb = kb
+        self.at = at
+        self.input_loincs = kb.kb_dec.get_input_loincs()
+        self.states = states
+        self.protocols = protocols
+        self.outdated -= set(patient_ids)
+
+    def invalidate(self, patient_id, loinc, trans_time):
+        """
+        Mark a patient as outdated after a change of one of its observations.
+        Args:
+            patient_id: ID of the patient
+            loinc: LOINC-NUM of the changed observation
+            trans_time: transaction time of the change
+        """
+        if not self.refreshing and (self.at is None or str(loinc) not in self.input_loincs
+                                    or pd.Timestamp(trans_time) > self.at):
+            return
+        self.outdated.add(patient_id)
+
+    def replace(self, patient_ids, states, protocols):
+        """
+        Replace the states and protocol actions of some patients by their new inference.
+        The patients outdated while they were inferred stay outdated.
+        """
+        patient_ids = list(patient_ids)
+        self.states = pd.concat([self.states[~self.states['ID'].isin(patient_ids)], states]) \
+            .sort_values('ID', kind='stable').reset_index(drop=True)
+        self.protocols = pd.concat([self.protocols[~self.protocols.index.get_level_values(0).isin(patient_ids)], protocols]) \
+            .sort_index()
+        self.outdated -= set(patient_ids)
+
+
+def _copy(result):
+    # results of the read methods are copied in and out of the query cache, the callers modify them
+    if isinstance(result, tuple):
+        return tuple(_copy(item) for item in result)
+    return result.copy() if hasattr(result, 'copy') else result
+
+
+class QueryCache:
+    """
+    Bounded LRU cache of the results of the read methods (retrieval, history_retrival).
+    The key holds the normalized arguments of the call, the knowledge base and the version of the database,
+    which update, delete and ingest increase, so a changed database never hits an older result.
+    The engine is shared by the threads of the UI: the entries and the counters change under a lock,
+    and a miss is computed outside of it.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize  # 0 disables the cache
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        """
+        Args:
+            key: hashable normalized arguments
+            compute: function computing the result on a miss
+        Returns:
+            a copy of the cached (or computed) result
+        """
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            else:
+                self.misses += 1
+        if cached is not None:
+            return _copy(cached)  # the cached results are never modified, the copy does not need the lock
+        result = compute()
+        if self.maxsize > 0:
+            cached = _copy(result)
+            with self.lock:
+                self.entries[key] = cached
+                if len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def info(self):
+        """
+        Returns:
+            dict: hits, misses, size and maxsize of the cache
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.maxsize}
+
+
+class DSS_Engine:
+    def __init__(self, db=None, use_good_after=False, kb=None, journal=None, store=None, workers=None, query_cache_size=256):
+        self.store = store  # ParquetStore or SQLiteStore to read and write instead of the in-memory db
+        self.table = ObservationTable(db) if store is None else None  # growable table behind self.db
+        self.journal = journal  # TransactionLog of the db, None to rewrite the csv on save
+        self.use_good_after = use_good_after  # end the validity window with good_after instead of good_before
+        self.index = BitemporalIndex(self.db) if store is None else None
+        self.patients = PatientRegistry(self.db if store is None else store.patients())
+        self.snapshot_order = None  # positions of the db sorted for the as-of snapshot, None when outdated
+        self.state_cache = StateCache()
+        self.version = 0  # increased by every change of the database (the key of the query cache)
+        self.query_cache = QueryCache(query_cache_size)
+        self.parallel = ParallelInference(workers) if workers is not None and workers > 1 else None  # None: serial inference
         self.save_db = False
-        self.kb = KB('kb_dec.xlsx', 'kb_proc.xlsx')
+        self.kb = KB('kb_dec.xlsx', 'kb_proc.xlsx') if kb is None else kb
         # try:
         #     self.db.insert(4,'LOINC-NAME', self.db['LOINC-NUM'].map(dict(self.kb.kb_dec.get_full_loinc_desc().values)))
         # except:
         #     self.db['LOINC-NAME'] = self.db['LOINC-NUM'].map(dict(self.kb.kb_dec.get_full_loinc_desc().values))
 
 
+    @property
+    def db(self):
+        return None if self.table is None else self.table.frame()
+
+    @db.setter
+    def db(self, db):
+        # a new db: rebuild everything derived from the rows
+        self.table = ObservationTable(db)
+        self.index = BitemporalIndex(self.db)
+        self.patients = PatientRegistry(self.db)
+        self.snapshot_order = None
+        self.state_cache = StateCache()
+        self.version += 1
+
+    def _select(self, first_name, last_name, loinc, valid_from=None, valid_to=None, trans_to=None, alive_at=None):
+        # rows of a patient and a LOINC-NUM, from the index or pushed down to the store
+        # (alive_at pre-filters deleted rows in the store, filter_deleted_rows is still applied by the caller)
+        if self.store is not None:
+            return self.store.read(first_name=first_name, last_name=last_name, loinc=loinc,
+                                   valid_from=valid_from, valid_to=valid_to, trans_to=trans_to, alive_at=alive_at)
+        labels = self.index.search(first_name, last_name, loinc, valid_from=valid_from, valid_to=valid_to, trans_to=trans_to)
+        return self.db.loc[labels]
+
+    @profiled('engine.retrieval')
     def retrieval(self, loinc, first_name, last_name, current_date, current_time, component_date, component_time=None):
         # Filter the point of view of the physician
-        physician_date = pd.to_datetime(f'{current_date} {current_time}')
+        physician_date = _to_datetime(current_date, current_time)
         # rel_db = self.db.loc[:physician_date]  # Relevant Database
 
-        # Filter according to the conditions
-        target_date = pd.to_datetime(component_date).date()  # Convert target date to date format
-        conditions = (self.db['First name'] == first_name) & (self.db['Last name'] == last_name) & \
-                     (self.db['LOINC-NUM'] == loinc) & (self.db['Valid start time'].dt.date == target_date) & \
-                     (self.db['Transaction time'] <= physician_date)
+        # Filter according to the conditions, the component day is [day_start, day_end)
+        # (or the exact component time when it is also provided)
+        if component_time:
+            valid_from = _to_datetime(component_date, component_time)
+            valid_to = valid_from + pd.Timedelta(1, unit='ns')
+        else:
+            valid_from, valid_to = _day_range(component_date)
+        # the version is read before the computation: a write racing with it can only fill an older entry
+        key = ('retrieval', self.version, self.kb, self.use_good_after, str(loinc), first_name, last_name,
+               physician_date, valid_from, valid_to)
+        return self.query_cache.get(key, lambda: self._retrieval(loinc, first_name, last_name, physician_date,
+                                                                 valid_from, valid_to, bool(component_time)))
 
-        filtered_df = self.db[conditions]
-        filtered_df = self.filter_deleted_rows(filtered_df, current_date, current_time)
+    def _retrieval(self, loinc, first_name, last_name, physician_date, valid_from, valid_to, exact):
+        filtered_df = self._select(first_name, last_name, loinc, valid_from=valid_from, valid_to=valid_to,
+                                   trans_to=physician_date, alive_at=physician_date)
+        filtered_df = _alive(filtered_df, physician_date)
 
-        # Check if the time of the component also provided
-        if component_time:
-            full_date = f'{component_date} {component_time}'
-            selected_row = filtered_df[filtered_df['Valid start time'] == full_date]
+        if exact:
+            selected_row = filtered_df
         else:
             selected_row = filtered_df.sort_values('Valid start time', ascending=False).head(1)
 
-        selected_row = self.filter_best_before(selected_row, current_date, current_time)
+        selected_row = self.filter_best_before(selected_row, physician_date)
         return selected_row['Value'], selected_row['Unit'], selected_row['Valid']
 
+    @profiled('engine.history_retrival')
     def history_retrival(self, loinc, first_name, last_name, from_date, from_time, to_date, trans_date, to_time=None,
                          trans_time=None):
-        target_date = pd.to_datetime(trans_date).date()
-        start = pd.to_datetime(f'{from_date} {from_time}')
-        end = pd.to_datetime(to_date).date()
+        args = self._history_args(from_date, from_time, to_date, trans_date, to_time, trans_time)
+        key = ('history_retrival', self.version, self.kb, self.use_good_after, str(loinc), first_name, last_name) + args
+        return self.query_cache.get(key, lambda: self._history_retrival(loinc, first_name, last_name, *args))
+
+    @staticmethod
+    def _history_args(from_date, from_time, to_date, trans_date, to_time, trans_time):
+        # normalized arguments of history_retrival:
+        # start, end, trans_end, full_date (point of view), at_trans_time, full_end_time
+        start = _to_datetime(from_date, from_time)
+        _, end = _day_range(to_date)
+        _, trans_end = _day_range(trans_date)
+        # without a transaction time the point of view is the start of the transaction day
+        full_date = _to_datetime(trans_date, trans_time) if trans_time else _day_range(trans_date)[0]
+        full_end_time = _to_datetime(to_date, to_time) if to_time else None
+        return start, end, trans_end, full_date, bool(trans_time), full_end_time
+
+    def iter_history_retrival(self, loinc, first_name, last_name, from_date, from_time, to_date, trans_date, to_time=None,
+                              trans_time=None, chunksize=100000):
+        """
+        Same as history_retrival, in chunks of at most chunksize rows with the same columns.
+        With the in-memory table only the positions of the rows are kept between the chunks,
+        and a store is read chunk by chunk (iter_read).
+        Yields:
+            pd.DataFrame: the next rows of history_retrival
+        """
+        start, end, trans_end, full_date, at_trans_time, full_end_time = self._history_args(
+            from_date, from_time, to_date, trans_date, to_time, trans_time)
+        if self.store is not None:
+            chunks = self.store.iter_read(chunksize, first_name=first_name, last_name=last_name, loinc=loinc,
+                                          valid_from=start, valid_to=end, trans_to=trans_end - pd.Timedelta(1, unit='ns'),
+                                          alive_at=full_date)
+            yield from _rechunk((self._history_filter(_alive(rows, full_date), full_date, at_trans_time, full_end_time)
+                                 for rows in chunks), chunksize)
+            return
+
+        # the filters of _history_retrival on the int64 columns of the table
+        table = self.table
+        labels = self.index.search(first_name, last_name, loinc, valid_from=start, valid_to=end,
+                                   trans_to=trans_end - pd.Timedelta(1, unit='ns'))
+        positions = table.positions(labels)
+        stop = table.epoch('Transaction stop time')[positions]
+        positions = positions[(stop == BitemporalIndex.NAT) | (stop > full_date.value)]
+        if full_end_time is not None:
+            positions = positions[table.epoch('Valid start time')[positions] == full_end_time.value]
+        elif at_trans_time:
+            positions = positions[table.epoch('Transaction time')[positions] <= full_date.value]
+        for chunk_start in range(0, len(positions), chunksize):
+            yield self.filter_best_before(self.db.take(positions[chunk_start:chunk_start + chunksize]), full_date)
 
+    def _history_retrival(self, loinc, first_name, last_name, start, end, trans_end, full_date, at_trans_time, full_end_time):
         # Filter according to the conditions
-        conditions = (self.db['First name'] == first_name) & (self.db['Last name'] == last_name) & \
-                     (self.db['LOINC-NUM'] == loinc) & (self.db['Transaction time'].dt.date <= target_date) & \
-                     (self.db['Valid start time'] >= start) & (self.db['Valid start time'].dt.date <= end)
-        filtered_df = self.db[conditions]
-
-        if trans_time:
-            filtered_df = self.filter_deleted_rows(filtered_df, trans_date, trans_time)
-            full_date = pd.to_datetime(f'{trans_date} {trans_time}')
+        filtered_df = self._select(first_name, last_name, loinc, valid_from=start, valid_to=end,
+                                   trans_to=trans_end - pd.Timedelta(1, unit='ns'), alive_at=full_date)
+        filtered_df = _alive(filtered_df, full_date)
+        return self._history_filter(filtered_df, full_date, at_trans_time, full_end_time)
+
+    def _history_filter(self, filtered_df, full_date, at_trans_time, full_end_time):
+        # the row filters of history_retrival after the select, and the best before validity
+        if at_trans_time:
             selected_row = filtered_df[filtered_df['Transaction time'] <= full_date]
         else:
-            current_time = '00:00'
-            filtered_df = self.filter_deleted_rows(filtered_df, trans_date, current_time)
             selected_row = filtered_df
 
-        if to_time:
-            full_end_time = pd.to_datetime(f'{to_date} {to_time}')
+        if full_end_time is not None:
             selected_row = filtered_df[filtered_df['Valid start time'] == full_end_time]
 
-        if trans_time:
-            selected_row = self.filter_best_before(selected_row, trans_date, trans_time)
-        else:
-            selected_row = self.filter_best_before(selected_row, trans_date, current_time)
+        selected_row = self.filter_best_before(selected_row, full_date)
         return selected_row
 
+    def _history_range_rows(self, at, patient_ids, loincs, valid_from, valid_to, trans_to):
+        # rows of the range query sorted by ID, LOINC-NUM, 'Valid start time' and 'Transaction time':
+        # (db, positions) for the table, or (rows, None) read from the store
+        at = _to_datetime(at)
+        trans_to = at if trans_to is None else _to_datetime(trans_to)
+        valid_from = None if valid_from is None else _to_datetime(valid_from)
+        valid_to = None if valid_to is None else _to_datetime(valid_to)
+        sort_columns = ['ID', 'LOINC-NUM', 'Valid start time', 'Transaction time']
+        if self.store is not None:
+            rows = _alive(self.store.read(**self._history_range_filters(at, patient_ids, loincs, valid_from, valid_to, trans_to)), at)
+            return rows.sort_values(sort_columns, kind='stable'), at
+
+        # one pass of masks over the columns of the table for all the patients and LOINC-NUMs
+        table = self.table
+        NAT = BitemporalIndex.NAT
+        valid = table.epoch('Valid start time')
+        trans = table.epoch('Transaction time')
+        stop = table.epoch('Transaction stop time')
+        mask = (valid != NAT) & (trans != NAT) & (trans <= trans_to.value) & ((stop == NAT) | (stop > at.value))
+        if valid_from is not None:
+            mask &= valid >= valid_from.value
+        if valid_to is not None:
+            mask &= valid < valid_to.value
+        if patient_ids is not None:
+            mask &= np.isin(table.arrays['ID'][:table.n], list(patient_ids))
+        if loincs is not None:
+            mask &= np.isin(table.codes('LOINC-NUM'), table.codes('LOINC-NUM', [str(loinc) for loinc in loincs]))
+        positions = np.flatnonzero(mask)
+        # the categories are sorted, so the LOINC-NUM codes sort as the LOINC-NUMs
+        order = np.lexsort((trans[positions], valid[positions], table.codes('LOINC-NUM')[positions], table.arrays['ID'][:table.n][positions]))
+        return positions[order], at
+
+    @staticmethod
+    def _history_range_filters(at, patient_ids, loincs, valid_from, valid_to, trans_to):
+        # the filters of the range query pushed down to the store
+        return dict(valid_from=valid_from, valid_to=valid_to, trans_to=trans_to, alive_at=at,
+                    patient_ids=None if patient_ids is None else list(patient_ids),
+                    loincs=None if loincs is None else [str(loinc) for loinc in loincs])
+
+    def _history_range_chunk(self, rows, at):
+        # best before validity of the rows at the point of view
+        return self.filter_best_before(rows.copy(), at)
+
+    @profiled('engine.history_range')
+    def history_range(self, at, patient_ids=None, loincs=None, valid_from=None, valid_to=None, trans_to=None):
+        """
+        History of many patients and LOINC-NUMs in one query (history_retrival of every pair, as one long frame).
+        Args:
+            at: point of view, the rows deleted at this time are dropped and 'Valid' is their best before validity at this time
+            patient_ids: IDs of the patients, None for all the patients
+            loincs: LOINC-NUMs, None for all the LOINC-NUMs
+            valid_from: first 'Valid start time' (inclusive), None for no limit
+            valid_to: last 'Valid start time' (exclusive), None for no limit
+            trans_to: last 'Transaction time' (inclusive), None for the point of view
+        Returns:
+            pd.DataFrame: rows sorted by ID, LOINC-NUM, 'Valid start time' and 'Transaction time', with the 'Valid' column
+        """
+        rows, at = self._history_range_rows(at, patient_ids, loincs, valid_from, valid_to, trans_to)
+        if self.store is None:
+            rows = self.db.take(rows)
+        return self._history_range_chunk(rows, at)
+
+    def iter_history_range(self, at, patient_ids=None, loincs=None, valid_from=None, valid_to=None, trans_to=None,
+                           chunksize=100000):
+        """
+        Same as history_range, in chunks of at most chunksize rows. With the in-memory table only the positions
+        of the rows are kept between the chunks, and a store is read chunk by chunk (iter_read sorted by key),
+        so the memory does not grow with the size of the windows.
+        Yields:
+            pd.DataFrame: the next rows of history_range
+        """
+        if self.store is not None:
+            at = _to_datetime(at)
+            trans_to = at if trans_to is None else _to_datetime(trans_to)
+            valid_from = None if valid_from is None else _to_datetime(valid_from)
+            valid_to = None if valid_to is None else _to_datetime(valid_to)
+            chunks = self.store.iter_read(chunksize, by_key=True, **self._history_range_filters(
+                at, patient_ids, loincs, valid_from, valid_to, trans_to))
+            for chunk in _rechunk((_alive(rows, at) for rows in chunks), chunksize):
+                yield self._history_range_chunk(chunk, at)
+            return
+        rows, at = self._history_range_rows(at, patient_ids, loincs, valid_from, valid_to, trans_to)
+        for start in range(0, len(rows), chunksize):
+            yield self._history_range_chunk(self.db.take(rows[start:start + chunksize]), at)
+
+    @profiled('engine.update')
     def update(self, loinc, first_name, last_name, trans_date, trans_time, component_date, component_time, new_value, only_preview_selected_row=False):
         # Filter according to the conditions
-        target_date = pd.to_datetime(f'{component_date} {component_time}')
-        conditions = (self.db['First name'] == first_name) & (self.db['Last name'] == last_name) & \
-                     (self.db['LOINC-NUM'] == loinc) & (self.db['Valid start time'] == target_date)
-
-        filtered_df = self.db[conditions]
-        filtered_df = self.filter_deleted_rows(filtered_df, trans_date, trans_time)
+        target_date = _to_datetime(component_date, component_time)
+        new_trans = _to_datetime(trans_date, trans_time)
+        filtered_df = self._select(first_name, last_name, loinc,
+                                   valid_from=target_date, valid_to=target_date + pd.Timedelta(1, unit='ns'),
+                                   alive_at=new_trans)
+        filtered_df = _alive(filtered_df, new_trans)
 
         selected_row = filtered_df.sort_values('Transaction time', ascending=False).head(1)
 
-        new_trans = pd.to_datetime(f'{trans_date} {trans_time}')
         if len(selected_row) == 0:
             return -1, -1
         
@@ -98,24 +586,34 @@ class DSS_Engine:
             'Valid stop time':selected_row['Valid stop time'].values[0],	
             'Transaction stop time':selected_row['Transaction stop time'].values[0],
             }])
-        self.db = pd.concat([self.db, new_row], ignore_index=True)
-        self.save_db = True
+        if self.store is not None:
+            self.store.append(new_row)
+        else:
+            label = self.table.append(new_row)[0]  # amortized O(1), no copy of the db
+            self.index.insert(label, first_name, last_name, loinc, new_row['Valid start time'][0], new_trans)
+            self.snapshot_order = None
+            if self.journal is not None:
+                self.journal.append_insert(new_row.iloc[0].to_dict())
+            self.save_db = True
+        self._changed([(new_row['ID'][0], loinc, new_trans)])
         return selected_row, new_row
 
+    @profiled('engine.delete')
     def delete(self, loinc, first_name, last_name, trans_date, trans_time, component_date, component_time, only_preview_selected_row=False):
         # Add 'Transaction Stop Time' When the there is a deletion
-        target_date = pd.to_datetime(component_date).date()  # Convert target date to date format
-        conditions = (self.db['First name'] == first_name) & (self.db['Last name'] == last_name) & \
-                     (self.db['LOINC-NUM'] == loinc) & (self.db['Valid start time'].dt.date == target_date)
-
-        filtered_df = self.db[conditions]
-        filtered_df = self.filter_deleted_rows(filtered_df, trans_date, trans_time)
-
+        trans_stop_date = _to_datetime(trans_date, trans_time)
+        # the component day is [day_start, day_end), or the exact component time when it is also provided
+        if component_time:
+            valid_from = _to_datetime(component_date, component_time)
+            valid_to = valid_from + pd.Timedelta(1, unit='ns')
+        else:
+            valid_from, valid_to = _day_range(component_date)
+        filtered_df = self._select(first_name, last_name, loinc, valid_from=valid_from, valid_to=valid_to,
+                                   alive_at=trans_stop_date)
+        filtered_df = _alive(filtered_df, trans_stop_date)
 
-        # Check if the time of the component also provided
         if component_time:
-            full_date = f'{component_date} {component_time}'
-            selected_row = filtered_df[filtered_df['Valid start time'] == full_date]
+            selected_row = filtered_df
         else:
             selected_row = filtered_df.sort_values('Valid start time', ascending=False).head(1)
         
@@ -125,57 +623,426 @@ class DSS_Engine:
         if only_preview_selected_row:
             return selected_row
 
-        trans_stop_date = pd.to_datetime(f'{trans_date} {trans_time}')  # Convert trans stop date to date format
-        self.db.at[selected_row.index[0], 'Transaction stop time'] = trans_stop_date
-        self.save_db = True
+        if self.store is not None:
+            self.store.set_stop(selected_row.index[0], selected_row['ID'].iloc[0], trans_stop_date)
+        else:
+            self.table.set_value(selected_row.index[0], 'Transaction stop time', trans_stop_date)
+            if self.journal is not None:
+                self.journal.append_stop(selected_row.index[0], trans_stop_date)
+            self.save_db = True
+        self._changed([(selected_row['ID'].iloc[0], loinc, trans_stop_date)])
 
         return selected_row.loc[selected_row.index[0]]
 
-    @staticmethod
-    def filter_deleted_rows(data, trans_date, trans_time):
-        mask = pd.isnull(data['Transaction stop time'])
-        certain_date = pd.to_datetime(f'{trans_date} {trans_time}')
-        condition = certain_date < data['Transaction stop time']
+    def _changed(self, changes):
+        # once the rows are written: outdate the changed patients and the cached query results.
+        # A read racing with the write keys its result by the old version, so it can not be cached under the new one.
+        for patient_id, loinc, trans in changes:
+            self.state_cache.invalidate(patient_id, loinc, trans)
+        self.version += 1
+
+    def _candidates(self, items):
+        # rows of the (First name, Last name, LOINC-NUM) of every item, with the position of the item in '_item'
+        keys = ['First name', 'Last name', 'LOINC-NUM']
+        if self.store is not None:
+            # one read of the patients and the LOINC-NUMs of the batch, joined to the items on the key columns
+            names = items[['First name', 'Last name']].drop_duplicates().itertuples(index=False)
+            patient_ids = sorted({patient_id for name in names for patient_id in self.patients.ids(*name)})
+            rows = self.store.read(patient_ids=patient_ids, loincs=list(items['LOINC-NUM'].unique()))
+            rows = rows.assign(_label=rows.index.to_numpy())
+            joined = pd.merge(items[keys].assign(_item=np.arange(len(items))), rows, on=keys, how='inner')
+            joined = joined.sort_values(['_item', '_label'], kind='stable').set_index('_label')
+            joined.index.name = None
+            return joined
+
+        # one join of the items and the rows on the integer codes of the categorical key columns
+        table = self.table
+        item_codes = pd.DataFrame({column: table.codes(column, items[column].to_numpy()) for column in keys})
+        item_codes['_item'] = np.arange(len(items))
+        item_codes = item_codes[(item_codes[keys].to_numpy() >= 0).all(axis=1)]
+        db_codes = {column: table.codes(column) for column in keys}
+        positions = np.flatnonzero(np.isin(db_codes['LOINC-NUM'], item_codes['LOINC-NUM'].to_numpy())
+                                   & np.isin(db_codes['Last name'], item_codes['Last name'].to_numpy()))
+        rows = pd.DataFrame({column: db_codes[column][positions] for column in keys})
+        rows['_position'] = positions
+        joined = pd.merge(item_codes, rows, on=keys, how='inner')
+        return self.db.take(joined['_position'].to_numpy()).assign(_item=joined['_item'].to_numpy())
 
-        # Apply the condition to the original DataFrame
-        result_df = data.loc[mask + condition]
-        return result_df
+    def _targets(self, items, valid_from, valid_to, order):
+        # label of the target row of every item (-1 if not found): a row with 'Valid start time' in
+        # [valid_from, valid_to) of the item, not deleted at its 'Transaction time', the first one in the order
+        trans = _to_ns(items['Transaction time'])
+        rows = self._candidates(items)
+        item = rows['_item'].to_numpy()
+        valid = _to_ns(rows['Valid start time'])
+        stop = _to_ns(rows['Transaction stop time'])
+        NAT = BitemporalIndex.NAT
+        rows = rows[(valid != NAT) & (valid >= valid_from[item]) & (valid < valid_to[item])
+                    & ((stop == NAT) | (stop > trans[item]))]
+        rows = rows.assign(_label=rows.index.to_numpy(), _valid=_to_ns(rows['Valid start time']), _trans=_to_ns(rows['Transaction time']))
+        rows = rows.sort_values(['_item'] + order, ascending=[True, False, True], kind='stable').drop_duplicates('_item')
+        targets = np.full(len(items), -1, dtype=np.int64)
+        targets[rows['_item'].to_numpy()] = rows['_label'].to_numpy()
+        return targets, rows.set_index('_item')
 
-    def filter_best_before(self, data, current_date, current_time):
+    @profiled('engine.update_many')
+    def update_many(self, corrections):
+        """
+        Correct many observations at once, same as update for every row of the corrections.
+        Args:
+            corrections (pd.DataFrame): LOINC-NUM, First name, Last name, Valid start time (of the corrected observation),
+                Transaction time (of the correction) and Value (the new value)
+        Returns:
+            pd.Series: label of the new row of every correction (indexed as the corrections), -1 if the observation is not found
+        """
+        items = corrections.reset_index(drop=True)
+        items = items.assign(**{column: pd.to_datetime(items[column]) for column in ['Transaction time', 'Valid start time']})
+        valid = _to_ns(items['Valid start time'])
+        # the newest row of the observation (the new rows of the batch copy the same cells, so the order does not matter)
+        targets, selected = self._targets(items, valid, valid + 1, ['_trans', '_label'])
+        outcome = pd.Series(np.full(len(items), -1, dtype=np.int64), index=corrections.index, name='label')
+        found = np.flatnonzero(targets != -1)
+        if len(found) == 0:
+            return outcome
+
+        selected = selected.loc[found]
+        new_rows = pd.DataFrame({
+            'ID': selected['ID'].to_numpy(),
+            'First name': items['First name'].to_numpy(dtype=object)[found],
+            'Last name': items['Last name'].to_numpy(dtype=object)[found],
+            'LOINC-NUM': items['LOINC-NUM'].to_numpy(dtype=object)[found],
+            'Value': items['Value'].to_numpy(dtype=object)[found],
+            'Unit': selected['Unit'].to_numpy(dtype=object),
+            'Transaction time': items['Transaction time'].to_numpy()[found],
+            'Valid start time': selected['Valid start time'].to_numpy(),
+            'Valid stop time': selected['Valid stop time'].to_numpy(),
+            'Transaction stop time': selected['Transaction stop time'].to_numpy(),
+            })
+        if self.store is not None:
+            labels = self.store.append(new_rows)
+        else:
+            labels = self.table.append(new_rows)
+            self.index.insert_many(labels, new_rows)
+            self.snapshot_order = None
+            if self.journal is not None:
+                self.journal.append_inserts(new_rows)
+            self.save_db = True
+        self._changed(new_rows[['ID', 'LOINC-NUM', 'Transaction time']].itertuples(index=False))
+        outcome.iloc[found] = labels
+        return outcome
+
+    @profiled('engine.delete_many')
+    def delete_many(self, deletions):
+        """
+        Delete many observations at once, same as delete for every row of the deletions (in their order).
+        Args:
+            deletions (pd.DataFrame): LOINC-NUM, First name, Last name, Transaction time (of the deletion) and
+                Valid start time (of the deleted observation), or Valid date for the last observation of a day
+                (where Valid start time is missing)
+        Returns:
+            pd.Series: label of the deleted row of every deletion (indexed as the deletions), -1 if the observation is not found
+        """
+        items = deletions.reset_index(drop=True)
+        items = items.assign(**{'Transaction time': pd.to_datetime(items['Transaction time'])})
+        valid = _to_ns(items['Valid start time']) if 'Valid start time' in items else np.full(len(items), BitemporalIndex.NAT)
+        day = _to_ns(pd.to_datetime(items['Valid date']).dt.normalize()) if 'Valid date' in items else np.full(len(items), BitemporalIndex.NAT)
+        exact = valid != BitemporalIndex.NAT
+        valid_from = np.where(exact, valid, day)
+        valid_to = np.where(exact, valid + 1, day + pd.Timedelta(days=1).value)
+        valid_to[~exact & (day == BitemporalIndex.NAT)] = BitemporalIndex.NAT  # neither a time nor a day: not found
+
+        outcome = np.full(len(items), -1, dtype=np.int64)
+        pending = np.arange(len(items))
+        while len(pending):
+            # the deletions are resolved together up to the first one that targets a row deleted earlier in the batch,
+            # which is resolved again (as delete would) after the first ones are applied
+            batch = items.iloc[pending]
+            targets, selected = self._targets(batch, valid_from[pending], valid_to[pending], ['_valid', '_label'])
+            duplicated = np.flatnonzero(pd.Series(targets).duplicated().to_numpy() & (targets != -1))
+            cut = duplicated[0] if len(duplicated) else len(pending)
+            selected = selected[selected.index < cut]
+            outcome[pending[:cut]] = targets[:cut]
+            self._set_stops(selected.assign(_deletion=batch['Transaction time'].to_numpy()[selected.index.to_numpy()]))
+            pending = pending[cut:]
+        return pd.Series(outcome, index=deletions.index, name='label')
+
+    def _set_stops(self, selected):
+        # the 'Transaction stop time' of the selected rows (label in '_label') is the time of their deletion ('_deletion')
+        if len(selected) == 0:
+            return
+        labels = selected['_label'].to_numpy()
+        stop_times = selected['_deletion'].to_numpy()
+        if self.store is not None:
+            self.store.set_stops(labels, selected['ID'].to_numpy(), stop_times)
+        else:
+            self.table.set_values(labels, 'Transaction stop time', stop_times)
+            if self.journal is not None:
+                self.journal.append_stops(labels, stop_times)
+            self.save_db = True
+        self._changed(zip(selected['ID'], selected['LOINC-NUM'], stop_times))
+
+    @staticmethod
+    def filter_deleted_rows(data, trans_date, trans_time=None):
+        return _alive(data, _to_datetime(trans_date, trans_time))
+
+    @profiled('engine.best_before')
+    def filter_best_before(self, data, current_date, current_time=None):
         data['Valid'] = None
         if len(data) == 0:
             return data
 
-        current = pd.to_datetime(f'{current_date} {current_time}')
-
-        def func(row):
-            time_delta = self.kb.kb_dec.get_best_before(row['LOINC-NUM'])
-            if (row['Valid start time'] - time_delta[0]) <= current <= (row['Valid start time'] + time_delta[0]):
-                return True
-            return False
+        current = _to_datetime(current_date, current_time)
+        good_before, good_after = self.kb.kb_dec.get_best_before_batch(data['LOINC-NUM'])
+        good_until = good_after if self.use_good_after else good_before
 
-        data['Valid'] = data.apply(func, axis=1)
+        data['Valid'] = ((data['Valid start time'] - good_before) <= current) & \
+                        (current <= (data['Valid start time'] + good_until))
         return data
 
-    def get_patient_data(self, trans_date, trans_time):
-        certain_date = pd.to_datetime(f'{trans_date} {trans_time}')
+    @profiled('engine.snapshot')
+    def get_patient_data(self, trans_date, trans_time=None, patient_ids=None, with_typed_values=False):
+        certain_date = _to_datetime(trans_date, trans_time)
 
-        condition = (self.db['Transaction time'] <= certain_date)
-        filtered_df = self.db[condition]
-        filtered_df = self.filter_deleted_rows(filtered_df, trans_date, trans_time)
+        if self.store is not None:
+            last_patient_data = self.store.snapshot(certain_date)
+            if patient_ids is not None:
+                last_patient_data = last_patient_data[last_patient_data['ID'].isin(list(patient_ids))]
+            return last_patient_data
 
-        group_df = filtered_df.groupby(['ID', 'LOINC-NUM'], as_index=False)
-        last_patient_data = group_df.apply(lambda x: x.sort_values(["Valid start time", "Transaction time"],
-                                                                   ascending=[False, False]).head(1))
+        # the typed value columns (ObservationTable) spare the inference the coercion of Value
+        db = self.table.frame(with_typed_values=with_typed_values)
+        if patient_ids is None:
+            return db.take(self._snapshot_positions(certain_date))
+
+        # a few patients: sort only their rows (same order as the global sort)
+        sorted_db = db[db['ID'].isin(list(patient_ids))].sort_values(
+            ['ID', 'LOINC-NUM', 'Valid start time', 'Transaction time'],
+            ascending=[True, True, False, False], kind='stable')
+        filtered_df = _alive(sorted_db[sorted_db['Transaction time'] <= certain_date], certain_date)
+        last_patient_data = filtered_df.drop_duplicates(['ID', 'LOINC-NUM'], keep='first')
         return last_patient_data
 
-    def get_states(self, trans_date='2018-5-22', trans_time='11:30'):
-        patient_data = self.get_patient_data(trans_date=trans_date, trans_time=trans_time)
-        return patient_data.groupby('ID').apply(self.kb.inference_protocol)
+    def _snapshot_positions(self, certain_date):
+        # positions in the table of the rows of the as-of snapshot, in the order of get_patient_data
+        table = self.table
+        if self.snapshot_order is None:
+            # One global sort (newest valid time and then newest transaction first), reused until the db changes
+            self.snapshot_order = table.frame().reset_index(drop=True).sort_values(
+                ['ID', 'LOINC-NUM', 'Valid start time', 'Transaction time'],
+                ascending=[True, True, False, False], kind='stable').index.to_numpy()
+        # known and not deleted at that time, compared on the int64 epoch columns before taking the rows
+        trans = table.epoch('Transaction time')
+        stop = table.epoch('Transaction stop time')
+        at = certain_date.value
+        known = (trans != BitemporalIndex.NAT) & (trans <= at) & ((stop == BitemporalIndex.NAT) | (stop > at))
+        positions = self.snapshot_order[known[self.snapshot_order]]
+        # the first row of every (ID, LOINC-NUM)
+        ids = table.arrays['ID'][:table.n][positions]
+        loincs = table.codes('LOINC-NUM')[positions]
+        first = np.ones(len(positions), dtype=bool)
+        first[1:] = (ids[1:] != ids[:-1]) | (loincs[1:] != loincs[:-1])
+        return positions[first]
+
+    def iter_patient_data(self, trans_date, trans_time=None, chunksize=100000, with_typed_values=False):
+        """
+        Same as get_patient_data (of all the patients), in chunks of at most chunksize rows with the same columns.
+        With the in-memory table only the positions of the rows are kept between the chunks,
+        and a store is read chunk by chunk (iter_snapshot).
+        Yields:
+            pd.DataFrame: the next rows of get_patient_data
+        """
+        certain_date = _to_datetime(trans_date, trans_time)
+        if self.store is not None:
+            yield from _rechunk(self.store.iter_snapshot(certain_date, chunksize), chunksize)
+            return
+        positions = self._snapshot_positions(certain_date)
+        db = self.table.frame(with_typed_values=with_typed_values)
+        for start in range(0, len(positions), chunksize):
+            yield db.take(positions[start:start + chunksize])
+
+    def _inference_batch(self, patient_data):
+        if self.parallel is not None:
+            return self.parallel.inference_batch(self.kb, patient_data, key='ID')
+        return self.kb.inference_batch(patient_data, key='ID')
+
+    def _inference(self, trans_date, trans_time):
+        # inference of all the patients, kept in the state cache and refreshed only for the changed patients
+        certain_date = _to_datetime(trans_date, trans_time)
+        cache = self.state_cache
+        with profiler.span('engine.inference') as span:
+            # a copy of the outdated patients: update/delete of other threads add to the set during the read
+            ids = set(cache.outdated)
+            if not cache.is_valid(self.kb, certain_date):
+                cache.refreshing += 1
+                try:
+                    patient_data = self.get_patient_data(certain_date, with_typed_values=True)
+                    span.set(mode='full', rows=len(patient_data))
+                    cache.reset(self.kb, certain_date, *self._inference_batch(patient_data), patient_ids=ids)
+                finally:
+                    cache.refreshing -= 1
+            elif ids:
+                patient_data = self.get_patient_data(certain_date, patient_ids=ids, with_typed_values=True)
+                span.set(mode='incremental', rows=len(patient_data), patients=len(ids))
+                cache.replace(ids, *self._inference_batch(patient_data))
+            else:
+                span.set(mode='cached')
+        return cache
+
+    @staticmethod
+    def _states_time(trans_date, trans_time):
+        # a date string without a time is at 11:30 (the old default of trans_time), a timestamp keeps its own time
+        if trans_time is None and isinstance(trans_date, str) and ':' not in trans_date:
+            return '11:30'
+        return trans_time
+
+    def get_inferred_states(self, trans_date='2018-5-22', trans_time=None):
+        return self._inference(trans_date, self._states_time(trans_date, trans_time)).states.copy()
+
+    def get_states(self, trans_date='2018-5-22', trans_time=None):
+        return self._inference(trans_date, self._states_time(trans_date, trans_time)).protocols.copy()
+
+    @staticmethod
+    def _states_by_patient(states, protocols):
+        # patient ID -> (inferred states, protocol actions), to compare two inferences
+        result = {}
+        for patient_id, df in states.groupby('ID', sort=False):
+            result[patient_id] = (tuple(map(tuple, df[['Therapy_Code', 'Value']].to_numpy())), ())
+        for patient_id, df in protocols.groupby(level=0, sort=False):
+            result[patient_id] = (result.get(patient_id, ((), ()))[0], tuple(df.index.get_level_values(1)))
+        return result
+
+    @profiled('engine.ingest')
+    def ingest(self, observations, at=None):
+        """
+        Add a batch of new observations to the database.
+        Args:
+            observations (pd.DataFrame): new rows, 'Valid stop time' and 'Transaction stop time' may be missing
+            at: transaction time of the compared states, None for the last 'Transaction time' of the batch
+        Returns:
+            list: IDs of the patients whose inferred states or protocol actions at that time changed
+        """
+        rows = observations.reindex(columns=COLUMNS if self.store is not None else self.db.columns)
+        for column in DATE_COLUMNS:
+            rows[column] = pd.to_datetime(rows[column])
+        rows = rows.reset_index(drop=True)
+        if len(rows) == 0:
+            return []
+        at = rows['Transaction time'].max() if at is None else pd.Timestamp(at)
+
+        # only the patients with an observation read by the rules and known at that time can change
+        input_loincs = self.kb.kb_dec.get_input_loincs()
+        affected = rows[rows['LOINC-NUM'].astype(str).isin(input_loincs) & (rows['Transaction time'] <= at)]
+        patient_ids = set(affected['ID'])
+        if patient_ids:
+            before = self._states_by_patient(*self._inference_batch(
+                self.get_patient_data(at, patient_ids=patient_ids, with_typed_values=True)))
+
+        self.patients.add(rows)
+        if self.store is not None:
+            self.store.append(rows)
+        else:
+            labels = self.table.append(rows)
+            self.index.insert_many(labels, rows)
+            self.snapshot_order = None
+            if self.journal is not None:
+                self.journal.append_inserts(rows)
+            self.save_db = True
+        self._changed(affected[['ID', 'LOINC-NUM', 'Transaction time']].itertuples(index=False))
+
+        if not patient_ids:
+            return []
+        after = self._states_by_patient(*self._inference_batch(
+            self.get_patient_data(at, patient_ids=patient_ids, with_typed_values=True)))
+        return sorted(patient_id for patient_id in patient_ids if before.get(patient_id) != after.get(patient_id))
+
+    def ingest_stream(self, chunks, at=None):
+        """
+        Add new observations chunk by chunk (see read_observations).
+        Args:
+            chunks: iterable of pd.DataFrame
+            at: transaction time of the compared states, None for the last 'Transaction time' of every chunk
+        Yields:
+            list: IDs of the patients whose inferred states changed by every chunk
+        """
+        for chunk in chunks:
+            yield self.ingest(chunk, at=at)
+
+    def replay(self, times):
+        """
+        States of the patients at a sorted list of transaction times, in one pass over the transactions.
+        Between two times only the rows that become known ('Transaction time') or deleted ('Transaction stop time')
+        update the as-of snapshot, and only the patients whose snapshot changed are inferred again.
+        Args:
+            times: sorted transaction times
+        Yields:
+            (pd.Timestamp, ID, pd.DataFrame, pd.DataFrame): time, patient ID, inferred states (Therapy_Code, Value)
+            and protocol actions of every patient whose states or protocol actions changed at that time
+        """
+        db = self.table.frame(with_typed_values=True) if self.store is None else self.store.read()
+        # rank of every row in the order of the as-of snapshot (get_patient_data), the lowest alive rank of a
+        # (ID, LOINC-NUM) is its row in the snapshot
+        sorted_db = db.reset_index(drop=True).sort_values(['ID', 'LOINC-NUM', 'Valid start time', 'Transaction time'],
+                                                          ascending=[True, True, False, False], kind='stable')
+        patient_ids = sorted_db['ID'].to_numpy()
+        loincs = pd.factorize(sorted_db['LOINC-NUM'])[0]
+        trans = _to_ns(sorted_db['Transaction time'])
+        stop = _to_ns(sorted_db['Transaction stop time'])
+
+        # a row is in the snapshots from its 'Transaction time' until its 'Transaction stop time' (excluded)
+        NAT = BitemporalIndex.NAT
+        known = np.flatnonzero((trans != NAT) & ((stop == NAT) | (stop > trans)))
+        deleted = known[stop[known] != NAT]
+        event_time = np.concatenate([trans[known], stop[deleted]])
+        order = np.argsort(event_time, kind='stable')
+        event_time = event_time[order]
+        event_rank = np.concatenate([known, deleted])[order]
+        event_add = np.concatenate([np.ones(len(known), dtype=bool), np.zeros(len(deleted), dtype=bool)])[order]
+
+        alive = {}  # (ID, LOINC-NUM) -> ranks of the rows in the snapshot at the current time
+        keys_of_patient = {}
+        previous = {}
+        start = 0
+        for time in times:
+            time = pd.Timestamp(time)
+            end = np.searchsorted(event_time, _ns(time), side='right')
+            changed = set()
+            for rank, add in zip(event_rank[start:end], event_add[start:end]):
+                key = (patient_ids[rank], loincs[rank])
+                if add:
+                    alive.setdefault(key, set()).add(rank)
+                    keys_of_patient.setdefault(key[0], set()).add(key)
+                else:
+                    alive[key].discard(rank)
+                changed.add(key[0])
+            start = end
+            if not changed:
+                continue
+
+            ranks = sorted(min(alive[key]) for patient_id in changed for key in keys_of_patient[patient_id] if alive[key])
+            states, protocols = self._inference_batch(sorted_db.take(ranks))
+            result = self._states_by_patient(states, protocols)
+            states_of_patient = dict(tuple(states.groupby('ID', sort=False)))
+            protocols_of_patient = dict(tuple(protocols.groupby(level=0, sort=False)))
+            for patient_id in sorted(changed):
+                if result.get(patient_id) == previous.get(patient_id):
+                    continue
+                previous[patient_id] = result.get(patient_id)
+                yield (time, patient_id,
+                       states_of_patient.get(patient_id, states.iloc[:0])[['Therapy_Code', 'Value']].reset_index(drop=True),
+                       protocols_of_patient.get(patient_id, protocols.iloc[:0]).droplevel(0))
+
+    def close(self):
+        # stop the worker processes of the parallel inference
+        if self.parallel is not None:
+            self.parallel.close()
 
     def save(self, db_path):
         if self.save_db:
-            self.db.to_csv(db_path, index=False)
+            if self.journal is None:
+                self.db.to_csv(db_path, index=False)
+            elif self.journal.needs_compaction():
+                # the changes are already in the journal, the snapshot is rewritten only now and then
+                self.journal.compact(self.db)
             self.save_db = False
             return 'Database Saved!'
         return 'No Changes to Save!'
@@ -0,0 +1,202 @@
+import numpy as np
+import pandas as pd
+from KnowledgeBase import TYPED_VALUE_COLUMNS, typed_values
+
+CATEGORY_COLUMNS = ['First name', 'Last name', 'LOINC-NUM', 'Unit']
+
+
+def _codes_dtype(n_categories):
+    # same integer type as pandas picks for the codes of a Categorical (so no copy is needed)
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_categories < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+class ObservationTable:
+    """
+    Growable columnar table of the database rows.
+    Every column (and the row labels) is a numpy array with spare capacity that doubles when it is full,
+    so appending a batch of rows copies only the batch instead of the whole table.
+    The names, LOINC-NUM and Unit columns are kept as integer codes of sorted categories,
+    so they are pandas categoricals in the frame and their masks compare integers.
+    The Value column is also split once into a float64 and a categorical text column (typed_values),
+    which are in the frame only on request (frame(with_typed_values=True)).
+    frame() is a DataFrame over the filled part of the arrays (no copy), rebuilt only after a change.
+    """
+    def __init__(self, db, category_columns=CATEGORY_COLUMNS):
+        self.columns = list(db.columns)
+        self.n = len(db)
+        capacity = max(16, self.n)
+        self.labels = self._grow(db.index.to_numpy(), capacity)
+        self.categories = {}
+        self.arrays = {}
+        for column in self.columns:
+            if column in category_columns:
+                self._add_categorical(column, db[column], capacity)
+            else:
+                self.arrays[column] = self._grow(db[column].to_numpy(), capacity)
+        self.typed_columns = TYPED_VALUE_COLUMNS if 'Value' in self.columns else []
+        if self.typed_columns:
+            value_num, value_txt = typed_values(db['Value'])
+            self.arrays[self.typed_columns[0]] = self._grow(value_num.to_numpy(), capacity)
+            self._add_categorical(self.typed_columns[1], value_txt, capacity)
+        # labels 0..n-1 (the usual RangeIndex), the position of a label is the label itself
+        self.range_labels = bool(np.array_equal(self.labels[:self.n], np.arange(self.n)))
+        self.next_label = int(self.labels[:self.n].max()) + 1 if self.n else 0
+        self._frames = {}
+
+    def _add_categorical(self, column, values, capacity):
+        values = values.astype(object) if isinstance(values.dtype, pd.CategoricalDtype) else values
+        codes, categories = pd.factorize(values, sort=True)
+        self.categories[column] = pd.CategoricalDtype(pd.Index(categories))
+        self.arrays[column] = self._grow(codes.astype(_codes_dtype(len(categories))), capacity)
+
+    @staticmethod
+    def _grow(values, capacity):
+        array = np.empty(capacity, dtype=values.dtype)
+        array[:len(values)] = values
+        return array
+
+    def __len__(self):
+        return self.n
+
+    def _reserve(self, n_rows):
+        capacity = len(self.labels)
+        if self.n + n_rows <= capacity:
+            return
+        while capacity < self.n + n_rows:
+            capacity *= 2
+        self.labels = self._grow(self.labels[:self.n], capacity)
+        self.arrays = {column: self._grow(array[:self.n], capacity) for column, array in self.arrays.items()}
+
+    def _encode(self, column, values):
+        # codes of the values, new values are added to the categories (which stay sorted)
+        values = pd.Series(values, dtype=object)
+        categories = self.categories[column].categories
+        codes = categories.get_indexer(values)
+        new = (codes == -1) & values.notna().to_numpy()
+        if new.any():
+            new_categories = categories.union(pd.Index(values[new].unique()))
+            remap = np.append(new_categories.get_indexer(categories), -1)  # -1 (missing) stays -1
+            array = self.arrays[column].astype(_codes_dtype(len(new_categories)))
+            array[:self.n] = remap[array[:self.n]]
+            self.arrays[column] = array
+            self.categories[column] = pd.CategoricalDtype(new_categories)
+            codes = new_categories.get_indexer(values)
+        return codes
+
+    def _column(self, column, values):
+        # keep the column dtype when the new values fit in it, otherwise widen the column
+        if column in self.categories:
+            return self._encode(column, values)
+        array = self.arrays[column]
+        if values.dtype == array.dtype or array.dtype == object or np.can_cast(values.dtype, array.dtype, casting='same_kind'):
+            return values
+        dtype = np.result_type(array.dtype, values.dtype) if array.dtype.kind in 'biuf' and values.dtype.kind in 'biuf' else object
+        self.arrays[column] = array.astype(dtype)
+        return values
+
+    def append(self, rows):
+        """
+        Append rows to the table.
+        Args:
+            rows (pd.DataFrame): the new rows (with the columns of the table)
+        Returns:
+            np.ndarray: labels of the new rows
+        """
+        n_rows = len(rows)
+        labels = np.arange(self.next_label, self.next_label + n_rows)
+        self._reserve(n_rows)
+        for column in self.columns:
+            values = self._column(column, rows[column].to_numpy())
+            self.arrays[column][self.n:self.n + n_rows] = values
+        if self.typed_columns:
+            value_num, value_txt = typed_values(pd.Series(rows['Value'].to_numpy(dtype=object)))
+            self.arrays[self.typed_columns[0]][self.n:self.n + n_rows] = value_num.to_numpy()
+            self.arrays[self.typed_columns[1]][self.n:self.n + n_rows] = self._encode(self.typed_columns[1], value_txt.to_numpy(dtype=object))
+        self.labels[self.n:self.n + n_rows] = labels
+        self.n += n_rows
+        self.next_label += n_rows
+        self._frames = {}
+        return labels
+
+    def set_value(self, label, column, value):
+        """
+        Set one cell of the table.
+        """
+        position = int(label) if self.range_labels else self.frame().index.get_loc(label)
+        values = np.empty(1, dtype=object)
+        values[0] = value
+        self.arrays[column][position] = self._encode(column, values)[0] if column in self.categories else value
+        if column == 'Value' and self.typed_columns:
+            value_num, value_txt = typed_values(pd.Series(values))
+            self.arrays[self.typed_columns[0]][position] = value_num.iloc[0]
+            self.arrays[self.typed_columns[1]][position] = self._encode(self.typed_columns[1], value_txt.to_numpy(dtype=object))[0]
+        self._frames = {}
+
+    def epoch(self, column):
+        """
+        Args:
+            column (str): datetime column
+        Returns:
+            np.ndarray: the column as int64 nanoseconds since the epoch (NaT is the minimal int64), sharing its memory
+        """
+        values = self.arrays[column][:self.n]
+        if values.dtype != 'datetime64[ns]':
+            values = pd.to_datetime(pd.Series(values)).to_numpy(dtype='datetime64[ns]')
+        return values.view('int64')
+
+    def codes(self, column, values=None):
+        """
+        Args:
+            column (str): categorical column
+            values: values to encode, None for the codes of the column
+        Returns:
+            np.ndarray: codes of the values in the categories of the column (-1 for an unknown value)
+        """
+        if values is None:
+            return self.arrays[column][:self.n]
+        values = pd.Series(values)
+        values = values.astype(object) if isinstance(values.dtype, pd.CategoricalDtype) else values
+        return self.categories[column].categories.get_indexer(values)
+
+    def positions(self, labels):
+        """
+        Returns:
+            np.ndarray: positions of the labels in the table
+        """
+        labels = np.asarray(labels)
+        return labels.astype(np.int64) if self.range_labels else self.frame().index.get_indexer(labels)
+
+    def set_values(self, labels, column, values):
+        """
+        Set one (not categorical) column of many rows.
+        Args:
+            labels: labels of the rows
+            column (str): the column
+            values (np.ndarray): the new values
+        """
+        values = self._column(column, np.asarray(values))
+        self.arrays[column][self.positions(labels)] = values
+        self._frames = {}
+
+    def _values(self, column):
+        if column in self.categories:
+            return pd.Categorical.from_codes(self.arrays[column][:self.n], dtype=self.categories[column], validate=False)
+        return self.arrays[column][:self.n]
+
+    def frame(self, with_typed_values=False):
+        """
+        Args:
+            with_typed_values (bool): add the typed value columns
+        Returns:
+            pd.DataFrame: the table, sharing the memory of the arrays
+        """
+        if with_typed_values not in self._frames:
+            # a RangeIndex keeps the label lookups (db.loc) free of a hash table rebuilt after every append
+            index = pd.RangeIndex(self.n) if self.range_labels else pd.Index(self.labels[:self.n])
+            columns = self.columns + (self.typed_columns if with_typed_values else [])
+            self._frames[with_typed_values] = pd.DataFrame({column: self._values(column) for column in columns},
+                                                      index=index, copy=False)
+        return self._frames[with_typed_values]
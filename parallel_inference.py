@@ -0,0 +1,70 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pandas as pd
+from profiling import profiled
+
+_worker_kb = None  # KB of the worker process, sent once by the pool initializer
+
+
+def _init_worker(kb):
+    global _worker_kb
+    _worker_kb = kb
+
+
+def _inference_shard(df_db, key):
+    return _worker_kb.inference_batch(df_db, key=key)
+
+
+class ParallelInference:
+    """
+    KB.inference_batch over shards of patients in a pool of worker processes.
+    The KB is sent to every worker once (when the pool starts, and again only for a new KB).
+    The shards are consecutive ranges of the sorted patient IDs, so concatenating their results
+    in order gives the same result as the serial inference. Small inputs, a single worker or a
+    broken pool fall back to the serial inference.
+    """
+    def __init__(self, workers=None, min_patients=64):
+        self.workers = os.cpu_count() if workers is None else workers
+        self.min_patients = min_patients  # fewer patients are inferred serially
+        self.executor = None
+        self.kb = None
+
+    def _pool(self, kb):
+        if self.executor is None or self.kb is not kb:
+            self.close()
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(kb,))
+            self.kb = kb
+        return self.executor
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        self.executor = None
+        self.kb = None
+
+    @profiled('parallel.inference')
+    def inference_batch(self, kb, df_db, key='ID'):
+        """
+        Same as kb.inference_batch(df_db, key), over the worker processes.
+        Returns:
+            pd.DataFrame: dataframe of the inferred states
+            pd.DataFrame: dataframe of the inferred protocol actions indexed by key
+        """
+        patient_ids = np.sort(pd.unique(df_db[key]))
+        if self.workers <= 1 or len(patient_ids) < max(self.min_patients, 2):
+            return kb.inference_batch(df_db, key=key)
+
+        shards = [ids for ids in np.array_split(patient_ids, self.workers) if len(ids)]
+        try:
+            executor = self._pool(kb)
+            futures = [executor.submit(_inference_shard, df_db[df_db[key].isin(ids)], key) for ids in shards]
+            results = [future.result() for future in futures]
+        except BrokenProcessPool:
+            self.close()
+            return kb.inference_batch(df_db, key=key)
+
+        states = pd.concat([result[0] for result in results], ignore_index=True)
+        protocols = pd.concat([result[1] for result in results])
+        return states, protocols
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+
+class PatientRegistry:
+    """
+    Patients of the database: ID <-> (First name, Last name), in the order they first appear.
+    The engine and the UI resolve names here once instead of comparing the name columns of the db.
+    """
+    def __init__(self, db):
+        self.patients = None
+        self.by_name = {}
+        self.add(db)
+
+    def add(self, rows):
+        """
+        Register the new patients of some rows of the database.
+        Args:
+            rows (pd.DataFrame): rows with the ID, First name and Last name columns
+        """
+        patients = rows[['ID', 'First name', 'Last name']].astype({'First name': object, 'Last name': object}).drop_duplicates()
+        known = np.array([patient_id in self.by_name.get((first_name, last_name), [])
+                          for patient_id, first_name, last_name in patients.itertuples(index=False)], dtype=bool)
+        patients = patients[~known]
+        if self.patients is None:
+            self.patients = patients.reset_index(drop=True)
+        elif len(patients):
+            self.patients = pd.concat([self.patients, patients], ignore_index=True)
+        for patient_id, first_name, last_name in patients.itertuples(index=False):
+            self.by_name.setdefault((first_name, last_name), []).append(patient_id)
+
+    def ids(self, first_name, last_name):
+        """
+        Returns:
+            list: IDs of the patients with this name
+        """
+        return self.by_name.get((first_name, last_name), [])
+
+    def full_names(self):
+        """
+        Returns:
+            pd.Series: 'First name Last name' of every patient, indexed by ID
+        """
+        return pd.Series((self.patients['First name'] + ' ' + self.patients['Last name']).to_numpy(),
+                         index=self.patients['ID'].to_numpy(), name='Full name')
@@ -0,0 +1,193 @@
+import functools
+import json
+from collections import deque
+import threading
+import time
+import tracemalloc
+
+
+class _NullSpan:
+    """
+    Span of a disabled profiler, it records nothing.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+    Timed stage of a profiler, used as a context manager.
+    Every span records its wall time, its depth under the enclosing spans of the same thread,
+    the change of the traced memory (when the profiler traces memory) and its attributes (such as rows).
+    """
+    def __init__(self, profiler, name, attrs):
+        self.profiler = profiler
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        """
+        Add attributes to the span, such as set(rows=len(df)).
+        """
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        self.depth = len(stack)
+        stack.append(self)
+        self.memory = tracemalloc.get_traced_memory()[0] if self.profiler.trace_memory else None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        end = time.perf_counter()
+        self.profiler._stack().pop()
+        record = {
+            'name': self.name,
+            'start': self.start - self.profiler.origin,
+            'duration': end - self.start,
+            'depth': self.depth,
+            'thread': threading.get_ident(),
+            'memory_delta': None if self.memory is None else tracemalloc.get_traced_memory()[0] - self.memory,
+            'error': None if exc_type is None else exc_type.__name__,
+            **self.attrs,
+        }
+        self.profiler._record(record)
+        return False
+
+
+class Profiler:
+    """
+    Per-stage timings of the knowledge base and the engine.
+    The stages are spans (with profiler.span('name'): ...) or decorated methods (@profiled('name')).
+    A disabled profiler returns a shared span that does nothing, so the instrumentation is free until enable().
+    The hooks are called with every finished span (a dict), and the spans are exported as a Chrome/Perfetto JSON trace.
+    Only the last max_records spans are kept: a long-running process (such as the UI, which runs every rerun
+    in a new thread) would otherwise keep all of them.
+    """
+    def __init__(self, max_records=10000):
+        self.enabled = False
+        self.trace_memory = False
+        self.hooks = []
+        self.records = deque(maxlen=max_records)
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def enable(self, trace_memory=False):
+        """
+        Start recording the spans.
+        Args:
+            trace_memory (bool): also record the memory delta of every span (with tracemalloc, which slows down the code)
+        """
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.trace_memory = False
+
+    def clear(self, thread=None):
+        """
+        Drop the recorded spans (of one thread, or of all the threads).
+        """
+        with self.lock:
+            kept = () if thread is None else [record for record in self.records if record['thread'] != thread]
+            self.records = deque(kept, maxlen=self.records.maxlen)
+
+    def add_hook(self, hook):
+        """
+        Call hook(record) with every finished span.
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def span(self, name, **attrs):
+        """
+        Args:
+            name (str): stage name, such as 'kb_dec.1_1'
+            attrs: attributes of the span, such as rows
+        Returns:
+            Span: context manager timing the stage (a no-op when the profiler is disabled)
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, attrs)
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _record(self, record):
+        with self.lock:
+            self.records.append(record)
+        for hook in self.hooks:
+            hook(record)
+
+    def spans(self, thread=None):
+        """
+        Returns:
+            list: finished spans (of one thread, or of all the threads) in the order they finished
+        """
+        with self.lock:
+            return [record for record in self.records if thread is None or record['thread'] == thread]
+
+    def to_trace(self, thread=None):
+        """
+        Returns:
+            dict: the spans in the Chrome trace event format (chrome://tracing, ui.perfetto.dev)
+        """
+        events = []
+        for record in self.spans(thread):
+            args = {key: value for key, value in record.items() if key not in ('name', 'start', 'duration', 'thread')}
+            events.append({'name': record['name'], 'ph': 'X', 'pid': 0, 'tid': record['thread'],
+                           'ts': record['start'] * 1e6, 'dur': record['duration'] * 1e6, 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export(self, path, thread=None):
+        """
+        Write the spans as a JSON trace.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_trace(thread), f, default=str)
+
+
+profiler = Profiler()  # profiler of the knowledge base and the engine, disabled by default
+
+
+def profiled(name):
+    """
+    Decorator timing every call of a function as a span of the profiler,
+    the rows of the span are the length of the result when it is a DataFrame or a Series.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            with profiler.span(name) as span:
+                result = function(*args, **kwargs)
+                if hasattr(result, 'shape'):
+                    span.set(rows=len(result))
+                return result
+        return wrapper
+    return decorator
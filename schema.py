@@ -0,0 +1,4 @@
+# columns of the observation database, shared by the engine, the stores, the journal and the benchmark
+COLUMNS = ['ID', 'First name', 'Last name', 'LOINC-NUM', 'Value', 'Unit',
+           'Transaction time', 'Valid start time', 'Valid stop time', 'Transaction stop time']
+DATE_COLUMNS = ['Transaction time', 'Valid start time', 'Valid stop time', 'Transaction stop time']
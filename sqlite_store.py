@@ -0,0 +1,214 @@
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+from schema import COLUMNS, DATE_COLUMNS
+
+
+def _ns(value):
+    return None if value is None or pd.isnull(value) else int(pd.Timestamp(value).value)
+
+
+def _quote(column):
+    return '"' + column + '"'
+
+
+class SQLiteStore:
+    """
+    SQLite database of the observations, one row per database row with its label in _row.
+    Times are stored as int64 nanoseconds (NULL for NaT), so the bitemporal filters are
+    indexed range scans over (ID, LOINC-NUM, 'Valid start time', 'Transaction time').
+    Every write is committed in its own transaction.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS observations (_row INTEGER PRIMARY KEY, ID INTEGER, '
+                '"First name" TEXT, "Last name" TEXT, "LOINC-NUM" TEXT, Value TEXT, Unit TEXT, '
+                '"Transaction time" INTEGER, "Valid start time" INTEGER, "Valid stop time" INTEGER, "Transaction stop time" INTEGER)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS observations_id ON observations '
+                              '(ID, "LOINC-NUM", "Valid start time", "Transaction time")')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS observations_name ON observations '
+                              '("First name", "Last name", "LOINC-NUM", "Valid start time", "Transaction time")')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS observations_trans ON observations ("Transaction time")')
+
+    def _to_records(self, df):
+        records = []
+        for label, row in zip(df.index, df[COLUMNS].itertuples(index=False)):
+            row = dict(zip(COLUMNS, row))
+            records.append([int(label), int(row['ID']), row['First name'], row['Last name'], row['LOINC-NUM'],
+                            None if pd.isnull(row['Value']) else str(row['Value']), row['Unit']]
+                           + [_ns(row[column]) for column in DATE_COLUMNS])
+        return records
+
+    def _to_frame(self, rows):
+        df = pd.DataFrame(rows, columns=['_row'] + COLUMNS)
+        for column in DATE_COLUMNS:
+            df[column] = pd.to_datetime(df[column].astype('float64'), unit='ns')
+        df['ID'] = df['ID'].astype(np.int64)
+        df = df.set_index(df.pop('_row').astype(np.int64))
+        df.index.name = None
+        return df
+
+    def _insert(self, df):
+        placeholders = ', '.join(['?'] * (len(COLUMNS) + 1))
+        columns = ', '.join(['_row'] + [_quote(column) for column in COLUMNS])
+        self.conn.executemany(f'INSERT INTO observations ({columns}) VALUES ({placeholders})', self._to_records(df))
+
+    def write(self, db):
+        """
+        Replace the content of the store by the database.
+        Args:
+            db (pd.DataFrame): the database, its index is kept as the row labels
+        """
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM observations')
+            self._insert(db)
+
+    def patients(self):
+        """
+        Returns:
+            pd.DataFrame: ID, First name and Last name of the patients, in the order they first appear
+        """
+        with self.lock:
+            rows = self.conn.execute('SELECT ID, "First name", "Last name" FROM observations '
+                                     'GROUP BY ID, "First name", "Last name" ORDER BY MIN(_row)').fetchall()
+        return pd.DataFrame(rows, columns=['ID', 'First name', 'Last name'])
+
+    def read(self, first_name=None, last_name=None, patient_id=None, loinc=None,
+             valid_from=None, valid_to=None, trans_to=None, alive_at=None, patient_ids=None, loincs=None):
+        """
+        Read the rows of the store with an indexed query.
+        Args:
+            first_name, last_name: patient name
+            patient_id: patient ID
+            loinc: LOINC-NUM
+            patient_ids: list of patient IDs, the rows of any of them
+            loincs: list of LOINC-NUMs, the rows of any of them
+            valid_from: first 'Valid start time' (inclusive)
+            valid_to: last 'Valid start time' (exclusive)
+            trans_to: last 'Transaction time' (inclusive)
+            alive_at: keep only the rows that are not deleted at this time
+        Returns:
+            pd.DataFrame: rows indexed by their labels, in the database order
+        """
+        where, params = self._where(first_name, last_name, patient_id, loinc, valid_from, valid_to, trans_to, alive_at,
+                                    patient_ids, loincs)
+        columns = ', '.join(['_row'] + [_quote(column) for column in COLUMNS])
+        with self.lock:
+            rows = self.conn.execute(f'SELECT {columns} FROM observations{where} ORDER BY _row', params).fetchall()
+        return self._to_frame(rows)
+
+    def iter_read(self, chunksize=100000, by_key=False, **filters):
+        """
+        Read the rows of the store chunk by chunk, with a cursor (fetchmany) instead of all the rows at once.
+        Args:
+            chunksize (int): number of rows of every chunk
+            by_key (bool): sort the rows by ID, LOINC-NUM, 'Valid start time', 'Transaction time' (and label)
+                instead of the database order
+            filters: the filters of read
+        Yields:
+            pd.DataFrame: the next rows, indexed by their labels
+        """
+        where, params = self._where(**filters)
+        columns = ', '.join(['_row'] + [_quote(column) for column in COLUMNS])
+        # NULL times last, as pandas sorts NaT
+        order = ('ID, "LOINC-NUM", "Valid start time" IS NULL, "Valid start time", '
+                 '"Transaction time" IS NULL, "Transaction time", _row') if by_key else '_row'
+        return self._iter_query(f'SELECT {columns} FROM observations{where} ORDER BY {order}', params, chunksize)
+
+    def _iter_query(self, query, params, chunksize):
+        with self.lock:
+            cursor = self.conn.execute(query, params)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(chunksize)
+            if not rows:
+                return
+            yield self._to_frame(rows)
+
+    def _where(self, first_name=None, last_name=None, patient_id=None, loinc=None,
+               valid_from=None, valid_to=None, trans_to=None, alive_at=None, patient_ids=None, loincs=None):
+        # WHERE clause and parameters of the filters of read
+        conditions, params = [], []
+        for column, op, value in [('First name', '=', first_name), ('Last name', '=', last_name),
+                                  ('ID', '=', None if patient_id is None else int(patient_id)), ('LOINC-NUM', '=', loinc),
+                                  ('Valid start time', '>=', _ns(valid_from)), ('Valid start time', '<', _ns(valid_to)),
+                                  ('Transaction time', '<=', _ns(trans_to))]:
+            if value is not None:
+                conditions.append(f'{_quote(column)} {op} ?')
+                params.append(value)
+        for column, values in [('ID', None if patient_ids is None else [int(value) for value in patient_ids]),
+                               ('LOINC-NUM', None if loincs is None else list(loincs))]:
+            if values is not None:
+                conditions.append(f'{_quote(column)} IN ({", ".join("?" * len(values))})')
+                params.extend(values)
+        if alive_at is not None:
+            conditions.append('("Transaction stop time" IS NULL OR "Transaction stop time" > ?)')
+            params.append(_ns(alive_at))
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        return where, params
+
+    def snapshot(self, at):
+        """
+        Get the latest row of every (ID, LOINC-NUM) known and not deleted at a transaction time.
+        Args:
+            at: transaction time
+        Returns:
+            pd.DataFrame: rows sorted by ID and LOINC-NUM
+        """
+        with self.lock:
+            rows = self.conn.execute(self._snapshot_query(), [_ns(at), _ns(at)]).fetchall()
+        return self._to_frame(rows)
+
+    def iter_snapshot(self, at, chunksize=100000):
+        """
+        Same as snapshot, chunk by chunk with a cursor.
+        Yields:
+            pd.DataFrame: the next rows of the snapshot
+        """
+        return self._iter_query(self._snapshot_query(), [_ns(at), _ns(at)], chunksize)
+
+    @staticmethod
+    def _snapshot_query():
+        columns = ', '.join(['_row'] + [_quote(column) for column in COLUMNS])
+        return (f'SELECT {columns} FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY ID, "LOINC-NUM" '
+                'ORDER BY "Valid start time" DESC, "Transaction time" DESC, _row) AS rank FROM observations '
+                'WHERE "Transaction time" <= ? AND ("Transaction stop time" IS NULL OR "Transaction stop time" > ?)) '
+                'WHERE rank = 1 ORDER BY ID, "LOINC-NUM"')
+
+    def append(self, rows):
+        """
+        Add new rows to the store.
+        Args:
+            rows (pd.DataFrame): the new rows
+        Returns:
+            np.ndarray: labels of the new rows
+        """
+        with self.lock, self.conn:
+            label = self.conn.execute('SELECT COALESCE(MAX(_row), -1) + 1 FROM observations').fetchone()[0]
+            labels = np.arange(label, label + len(rows))
+            self._insert(rows.set_axis(labels))
+        return labels
+
+    def set_stop(self, label, patient_id, stop_time):
+        """
+        Set the 'Transaction stop time' of a row.
+        """
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE observations SET "Transaction stop time" = ? WHERE _row = ?', [_ns(stop_time), int(label)])
+
+    def set_stops(self, labels, patient_ids, stop_times):
+        """
+        Set the 'Transaction stop time' of many rows in one transaction.
+        Args:
+            labels: labels of the rows
+            patient_ids: IDs of the patients of the rows
+            stop_times: new 'Transaction stop time' of every row
+        """
+        with self.lock, self.conn:
+            self.conn.executemany('UPDATE observations SET "Transaction stop time" = ? WHERE _row = ?',
+                                  [(_ns(stop_time), int(label)) for label, stop_time in zip(labels, stop_times)])
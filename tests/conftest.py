@@ -0,0 +1,66 @@
+import os
+import shutil
+import sys
+
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from KnowledgeBase import KB  # noqa: E402
+from benchmark.generator import generate_db  # noqa: E402
+from schema import DATE_COLUMNS  # noqa: E402
+
+DB_PATH = os.path.join(ROOT, 'project_db_updated.csv')
+
+
+@pytest.fixture(scope='session')
+def kb():
+    return KB(os.path.join(ROOT, 'kb_dec.xlsx'), os.path.join(ROOT, 'kb_proc.xlsx'))
+
+
+@pytest.fixture
+def db():
+    """
+    The example database of the repository.
+    """
+    return pd.read_csv(DB_PATH, parse_dates=DATE_COLUMNS)
+
+
+@pytest.fixture(scope='session')
+def synthetic_db(kb):
+    """
+    A synthetic database with corrections and deletions (copy it before changing it).
+    """
+    return generate_db(kb.kb_dec, n_patients=20, n_observations=15, n_corrections=4, n_deletions=3, seed=7)
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    """
+    A copy of the example database in a temporary directory.
+    """
+    path = tmp_path / 'db.csv'
+    shutil.copy(DB_PATH, path)
+    return str(path)
+
+
+def make_store(kind, db, path):
+    """
+    Write a database into a new store.
+    Args:
+        kind (str): 'sqlite' or 'parquet'
+        db (pd.DataFrame): the database
+        path: temporary directory of the store
+    """
+    os.makedirs(path, exist_ok=True)
+    if kind == 'sqlite':
+        from sqlite_store import SQLiteStore
+        store = SQLiteStore(os.path.join(path, 'db.sqlite'))
+    else:
+        pytest.importorskip('pyarrow')
+        from columnar_store import ParquetStore
+        store = ParquetStore(os.path.join(path, 'parquet'))
+    store.write(db)
+    return store
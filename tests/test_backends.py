@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import make_store
+from dss_engine import DSS_Engine
+
+
+class BaselineEngine:
+    """
+    The full-scan retrieval and history_retrival of the first version of the engine, the reference of the tests.
+    """
+    def __init__(self, db, kb):
+        self.db = db
+        self.kb = kb
+
+    def retrieval(self, loinc, first_name, last_name, current_date, current_time, component_date, component_time=None):
+        physician_date = pd.to_datetime(f'{current_date} {current_time}')
+        target_date = pd.to_datetime(component_date).date()
+        conditions = (self.db['First name'] == first_name) & (self.db['Last name'] == last_name) & \
+                     (self.db['LOINC-NUM'] == loinc) & (self.db['Valid start time'].dt.date == target_date) & \
+                     (self.db['Transaction time'] <= physician_date)
+        filtered_df = self.filter_deleted_rows(self.db[conditions], current_date, current_time)
+        if component_time:
+            selected_row = filtered_df[filtered_df['Valid start time'] == f'{component_date} {component_time}']
+        else:
+            selected_row = filtered_df.sort_values('Valid start time', ascending=False).head(1)
+        selected_row = self.filter_best_before(selected_row, current_date, current_time)
+        return selected_row['Value'], selected_row['Unit'], selected_row['Valid']
+
+    def history_retrival(self, loinc, first_name, last_name, from_date, from_time, to_date, trans_date, to_time=None,
+                         trans_time=None):
+        target_date = pd.to_datetime(trans_date).date()
+        start = pd.to_datetime(f'{from_date} {from_time}')
+        end = pd.to_datetime(to_date).date()
+        conditions = (self.db['First name'] == first_name) & (self.db['Last name'] == last_name) & \
+                     (self.db['LOINC-NUM'] == loinc) & (self.db['Transaction time'].dt.date <= target_date) & \
+                     (self.db['Valid start time'] >= start) & (self.db['Valid start time'].dt.date <= end)
+        filtered_df = self.db[conditions]
+        current_time = trans_time if trans_time else '00:00'
+        filtered_df = self.filter_deleted_rows(filtered_df, trans_date, current_time)
+        if trans_time:
+            selected_row = filtered_df[filtered_df['Transaction time'] <= pd.to_datetime(f'{trans_date} {trans_time}')]
+        else:
+            selected_row = filtered_df
+        if to_time:
+            selected_row = filtered_df[filtered_df['Valid start time'] == pd.to_datetime(f'{to_date} {to_time}')]
+        return self.filter_best_before(selected_row, trans_date, current_time)
+
+    @staticmethod
+    def filter_deleted_rows(data, trans_date, trans_time):
+        certain_date = pd.to_datetime(f'{trans_date} {trans_time}')
+        return data.loc[pd.isnull(data['Transaction stop time']) | (certain_date < data['Transaction stop time'])]
+
+    def filter_best_before(self, data, current_date, current_time):
+        data = data.copy()
+        data['Valid'] = None
+        if len(data) == 0:
+            return data
+        current = pd.to_datetime(f'{current_date} {current_time}')
+
+        def func(row):
+            time_delta = self.kb.kb_dec.get_best_before(row['LOINC-NUM'])
+            return bool((row['Valid start time'] - time_delta[0]) <= current <= (row['Valid start time'] + time_delta[0]))
+
+        data['Valid'] = data.apply(func, axis=1)
+        return data
+
+
+def _values(series):
+    # the stores read a missing Value as None, the csv as NaN
+    return [None if pd.isnull(value) else str(value) for value in series]
+
+
+def _queries(db, kb, n=40, seed=0):
+    """
+    Arguments of retrieval and history_retrival around the rows of the database.
+    """
+    rng = np.random.default_rng(seed)
+    # the rows with a best before (get_best_before of the baseline fails on the others)
+    rows = db[kb.kb_dec.get_best_before_batch(db['LOINC-NUM'])[0].notna().to_numpy()]
+    rows = rows.sample(n, random_state=seed)
+    for row, shift in zip(rows.itertuples(index=False), rng.integers(-2 * 24 * 60, 4 * 24 * 60, n)):
+        row = dict(zip(rows.columns, row))
+        valid = row['Valid start time']
+        current = row['Transaction time'] + pd.Timedelta(int(shift), unit='min')
+        yield row, valid, current
+
+
+@pytest.fixture(params=['index', 'sqlite', 'parquet'])
+def engine(request, synthetic_db, kb, tmp_path):
+    if request.param == 'index':
+        return DSS_Engine(db=synthetic_db.copy(), kb=kb)
+    return DSS_Engine(store=make_store(request.param, synthetic_db, str(tmp_path)), kb=kb)
+
+
+@pytest.fixture
+def baseline(synthetic_db, kb):
+    return BaselineEngine(synthetic_db.copy(), kb)
+
+
+def test_retrieval(engine, baseline, synthetic_db, kb):
+    for row, valid, current in _queries(synthetic_db, kb):
+        args = (row['LOINC-NUM'], row['First name'], row['Last name'],
+                current.strftime('%Y-%m-%d'), current.strftime('%H:%M'), valid.strftime('%Y-%m-%d'))
+        for component_time in [None, valid.strftime('%H:%M:%S')]:
+            expected = baseline.retrieval(*args, component_time)
+            result = engine.retrieval(*args, component_time)
+            assert _values(result[0]) == _values(expected[0]), args
+            assert list(result[1]) == list(expected[1]), args
+            assert list(result[2]) == list(expected[2]), args
+
+
+def test_history_retrival(engine, baseline, synthetic_db, kb):
+    columns = ['ID', 'LOINC-NUM', 'Unit', 'Transaction time', 'Valid start time', 'Transaction stop time', 'Valid']
+    for row, valid, current in _queries(synthetic_db, kb, seed=1):
+        start = valid - pd.Timedelta(3, unit='D')
+        for to_time, trans_time in [(None, None), (None, current.strftime('%H:%M')),
+                                    (valid.strftime('%H:%M:%S'), None), (valid.strftime('%H:%M:%S'), current.strftime('%H:%M'))]:
+            # with a to_time the range ends on the day of the row
+            end = valid if to_time else valid + pd.Timedelta(2, unit='D')
+            args = (row['LOINC-NUM'], row['First name'], row['Last name'], start.strftime('%Y-%m-%d'), start.strftime('%H:%M'),
+                    end.strftime('%Y-%m-%d'), current.strftime('%Y-%m-%d'))
+            expected = baseline.history_retrival(*args, to_time=to_time, trans_time=trans_time)
+            result = engine.history_retrival(*args, to_time=to_time, trans_time=trans_time)
+            assert list(result.index) == list(expected.index), args
+            assert result[columns].astype(object).equals(expected[columns].astype(object)), args
+            assert _values(result['Value']) == _values(expected['Value']), args
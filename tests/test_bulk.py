@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import make_store
+from dss_engine import DSS_Engine
+
+COLUMNS = ['ID', 'First name', 'Last name', 'LOINC-NUM', 'Unit', 'Transaction time', 'Valid start time',
+           'Valid stop time', 'Transaction stop time']
+
+
+@pytest.fixture(params=['index', 'sqlite', 'parquet'])
+def engines(request, synthetic_db, kb, tmp_path):
+    """
+    Two engines on the same database, one for the sequential writes and one for the batch writes.
+    """
+    if request.param == 'index':
+        return DSS_Engine(db=synthetic_db.copy(), kb=kb), DSS_Engine(db=synthetic_db.copy(), kb=kb)
+    return tuple(DSS_Engine(store=make_store(request.param, synthetic_db, str(tmp_path / name)), kb=kb)
+                 for name in ['sequential', 'batch'])
+
+
+def _rows(engine):
+    return engine.db if engine.store is None else engine.store.read()
+
+
+def _assert_same_db(sequential, batch):
+    expected, result = _rows(sequential), _rows(batch)
+    pd.testing.assert_frame_equal(result[COLUMNS].astype(object), expected[COLUMNS].astype(object))
+    pd.testing.assert_series_equal(result['Value'].astype(str), expected['Value'].astype(str))
+    for date in ['2018-05-20', '2018-06-01', '2018-06-15']:
+        pd.testing.assert_frame_equal(batch.get_states(date, '00:00'), sequential.get_states(date, '00:00'))
+
+
+def _observations(db, n, seed):
+    rows = db[db['LOINC-NUM'] != 'Gender'].sample(n, replace=True, random_state=seed)
+    shift = np.random.default_rng(seed).integers(-2 * 24 * 60, 4 * 24 * 60, n)
+    return rows, (rows['Transaction time'] + pd.to_timedelta(shift, unit='min')).to_numpy()
+
+
+def test_update_many(engines, synthetic_db):
+    sequential, batch = engines
+    rows, times = _observations(synthetic_db, 60, seed=1)
+    corrections = pd.DataFrame({
+        'LOINC-NUM': rows['LOINC-NUM'].to_numpy(), 'First name': rows['First name'].to_numpy(),
+        'Last name': rows['Last name'].to_numpy(), 'Valid start time': rows['Valid start time'].to_numpy(),
+        'Transaction time': times, 'Value': np.round(np.random.default_rng(1).uniform(0, 20, len(rows)), 1),
+        }, index=np.arange(100, 100 + len(rows)))
+    # unknown patients and observations are not found
+    corrections.loc[corrections.index[:3], 'First name'] = 'Nobody'
+    corrections.loc[corrections.index[3:5], 'Valid start time'] = pd.Timestamp('2017-01-01')
+
+    found = []
+    for correction in corrections.itertuples(index=False):
+        time = pd.Timestamp(correction[4])
+        result = sequential.update(correction[0], correction[1], correction[2], time.strftime('%Y-%m-%d'),
+                                   time.strftime('%H:%M:%S'), pd.Timestamp(correction[3]).strftime('%Y-%m-%d'),
+                                   pd.Timestamp(correction[3]).strftime('%H:%M:%S'), correction[5])
+        found.append(not isinstance(result[0], int))
+    labels = batch.update_many(corrections)
+
+    assert list(labels.index) == list(corrections.index)
+    assert list(labels != -1) == found
+    assert not all(found[:5]) and any(found)
+    _assert_same_db(sequential, batch)
+
+
+def test_delete_many(engines, synthetic_db):
+    sequential, batch = engines
+    rows, times = _observations(synthetic_db, 60, seed=2)
+    # deletions of the same observation twice, the second one deletes the previous row of the day (or nothing)
+    rows, times = pd.concat([rows, rows.iloc[:15]]), np.concatenate([times, times[:15] + np.timedelta64(1, 'h')])
+    by_day = np.random.default_rng(2).random(len(rows)) < .5
+    deletions = pd.DataFrame({
+        'LOINC-NUM': rows['LOINC-NUM'].to_numpy(), 'First name': rows['First name'].to_numpy(),
+        'Last name': rows['Last name'].to_numpy(),
+        'Valid start time': rows['Valid start time'].where(~by_day, pd.NaT).to_numpy(),
+        'Valid date': rows['Valid start time'].dt.normalize().to_numpy(), 'Transaction time': times,
+        })
+
+    expected = []
+    for deletion in deletions.itertuples(index=False):
+        time, exact = pd.Timestamp(deletion[5]), not pd.isnull(deletion[3])
+        component = pd.Timestamp(deletion[3] if exact else deletion[4])
+        result = sequential.delete(deletion[0], deletion[1], deletion[2], time.strftime('%Y-%m-%d'), time.strftime('%H:%M:%S'),
+                                   component.strftime('%Y-%m-%d'), component.strftime('%H:%M:%S') if exact else None)
+        expected.append(-1 if isinstance(result, int) else result.name)
+    labels = batch.delete_many(deletions)
+
+    assert list(labels) == expected
+    assert any(label != -1 for label in expected)
+    _assert_same_db(sequential, batch)
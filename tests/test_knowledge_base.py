@@ -0,0 +1,21 @@
+import pickle
+
+import pytest
+
+
+def test_compiled_kb_is_read_only(kb):
+    compiled_kb = kb.kb_dec.compiled_kb
+    with pytest.raises(TypeError):
+        compiled_kb['states'] = {}
+    with pytest.raises(TypeError):
+        compiled_kb['loinc_desc']['11218-5'] = 'changed'
+    # the read-only tables are pickled (binary cache, parallel inference) and read back read-only
+    compiled_kb = pickle.loads(pickle.dumps(kb.kb_dec)).compiled_kb
+    assert dict(compiled_kb['states']) == dict(kb.kb_dec.compiled_kb['states'])
+    with pytest.raises(TypeError):
+        compiled_kb['states']['x'] = 'changed'
+
+
+def test_best_before_of_unknown_loinc(kb):
+    with pytest.raises(ValueError, match='unknown LOINC 0000-0'):
+        kb.kb_dec.get_best_before('0000-0')
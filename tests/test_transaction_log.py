@@ -0,0 +1,64 @@
+import os
+
+import pandas as pd
+
+from dss_engine import DSS_Engine
+from transaction_log import TransactionLog
+
+
+def _engine(csv_path, kb):
+    journal = TransactionLog(csv_path)
+    return DSS_Engine(db=journal.load(), kb=kb, journal=journal)
+
+
+def _change(engine):
+    # a correction and a deletion of the example database
+    engine.update('30313-1', 'Avraham', 'Avraham', '2018-06-01', '11:00', '2018-05-22', '15:00', 9.9)
+    assert not isinstance(engine.delete('11218-5', 'Avraham', 'Avraham', '2018-06-01', '12:00', '2018-05-23', None), int)
+
+
+def _assert_same_db(result, expected):
+    pd.testing.assert_frame_equal(result.drop(columns='Value').astype(object), expected.drop(columns='Value').astype(object))
+    assert list(result['Value'].astype(str)) == list(expected['Value'].astype(str))
+
+
+def test_replay(csv_path, kb):
+    engine = _engine(csv_path, kb)
+    _change(engine)
+    assert os.path.exists(csv_path + '.journal')
+    _assert_same_db(TransactionLog(csv_path).load(), engine.db)
+
+
+def test_replay_after_crash_in_compact(csv_path, kb):
+    engine = _engine(csv_path, kb)
+    _change(engine)
+    expected = engine.db
+    # crash of compact() between the replace of the csv and the rewrite of the journal header:
+    # the snapshot already holds the changes of the journal
+    expected.to_csv(csv_path + '.tmp', index=False)
+    os.replace(csv_path + '.tmp', csv_path)
+    _assert_same_db(TransactionLog(csv_path).load(), expected)
+
+    # the changes after the recovery are not lost
+    engine = _engine(csv_path, kb)
+    engine.update('30313-1', 'Avraham', 'Avraham', '2018-06-02', '11:00', '2018-05-23', '15:00', 10.9)
+    assert len(engine.db) == len(expected) + 1
+    _assert_same_db(TransactionLog(csv_path).load(), engine.db)
+
+
+def test_torn_last_line(csv_path, kb):
+    engine = _engine(csv_path, kb)
+    _change(engine)
+    expected = engine.db
+    with open(csv_path + '.journal', 'a') as f:
+        f.write('{"op": "insert", "row": {"ID"')
+    _assert_same_db(TransactionLog(csv_path).load(), expected)
+
+
+def test_compact(csv_path, kb):
+    engine = _engine(csv_path, kb)
+    engine.journal.compact_every = 1
+    _change(engine)
+    assert engine.save(csv_path) == 'Database Saved!'
+    assert TransactionLog(csv_path)._read_events(len(engine.db)) == []
+    _assert_same_db(TransactionLog(csv_path).load(), engine.db)
@@ -0,0 +1,154 @@
+import datetime
+import json
+import os
+import numpy as np
+import pandas as pd
+from schema import DATE_COLUMNS
+
+
+def _to_json_value(value):
+    """
+    Convert a cell of the database to a JSON value (timestamps as ISO strings, NaN/NaT as null).
+    """
+    if value is None or (not isinstance(value, str) and pd.isnull(value)):
+        return None
+    if isinstance(value, (datetime.datetime, np.datetime64)):
+        return pd.Timestamp(value).isoformat()
+    if hasattr(value, 'item'):  # numpy scalars
+        return value.item()
+    return value
+
+
+class TransactionLog:
+    """
+    Append-only journal of the changes of the database, next to the csv snapshot.
+    Every change of the bitemporal model is one line of the journal:
+        {"op": "insert", "row": {...}}                          a new row (update)
+        {"op": "stop", "label": 12, "time": "2018-06-30T11:00:00"}  a 'Transaction stop time' (delete)
+    The first line is a header with the number of rows of the snapshot the journal applies to.
+    compact() writes the database into the snapshot and starts an empty journal.
+    """
+    def __init__(self, db_path, journal_path=None, compact_every=1000):
+        self.db_path = db_path
+        self.journal_path = f'{db_path}.journal' if journal_path is None else journal_path
+        self.compact_every = compact_every
+        self.n_events = 0
+        self.snapshot_rows = None
+
+    def load(self):
+        """
+        Read the snapshot and replay the journal.
+        Returns:
+            pd.DataFrame: the database
+        """
+        db = pd.read_csv(self.db_path, parse_dates=DATE_COLUMNS)
+        self.snapshot_rows = len(db)
+        events = self._read_events(len(db))
+        self.n_events = len(events)
+
+        inserts = [event['row'] for event in events if event['op'] == 'insert']
+        if inserts:
+            new_rows = pd.DataFrame(inserts, columns=db.columns)
+            for column in DATE_COLUMNS:
+                new_rows[column] = pd.to_datetime(new_rows[column])
+            db = pd.concat([db, new_rows], ignore_index=True)
+
+        stops = pd.DataFrame([event for event in events if event['op'] == 'stop'], columns=['op', 'label', 'time'])
+        if len(stops):
+            stops = stops.drop_duplicates('label', keep='last')
+            db.loc[stops['label'].to_numpy(), 'Transaction stop time'] = pd.to_datetime(stops['time']).to_numpy()
+        return db
+
+    def _read_events(self, n_rows):
+        if not os.path.exists(self.journal_path):
+            return []
+        with open(self.journal_path) as f:
+            lines = [line for line in f if line.strip()]
+        events = []
+        for line in lines:
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                break  # torn last line after a crash
+        if not events or events[0].get('op') != 'snapshot':
+            return events
+        if events[0]['rows'] != n_rows:
+            # crashed during compact(): the snapshot already holds the journal,
+            # the header is rewritten so that the next changes are not dropped with it
+            self._write_header(n_rows)
+            return []
+        return events[1:]
+
+    def _append(self, *events):
+        # all the events are written with a single fsync
+        if not os.path.exists(self.journal_path):
+            self._write_header(self._snapshot_rows() if self.snapshot_rows is None else self.snapshot_rows)
+        with open(self.journal_path, 'a') as f:
+            f.write(''.join(json.dumps(event) + '\n' for event in events))
+            f.flush()
+            os.fsync(f.fileno())
+        self.n_events += len(events)
+
+    def _snapshot_rows(self):
+        with open(self.db_path) as f:
+            return pd.read_csv(f, usecols=[0]).shape[0]
+
+    def _write_header(self, n_rows):
+        with open(self.journal_path + '.tmp', 'w') as f:
+            f.write(json.dumps({'op': 'snapshot', 'rows': n_rows}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.journal_path + '.tmp', self.journal_path)
+
+    def append_insert(self, row):
+        """
+        Log a new row of the database.
+        Args:
+            row (dict): column -> value
+        """
+        self._append({'op': 'insert', 'row': {column: _to_json_value(value) for column, value in row.items()}})
+
+    def append_inserts(self, rows):
+        """
+        Log new rows of the database.
+        Args:
+            rows (pd.DataFrame): the new rows
+        """
+        if len(rows):
+            self._append(*[{'op': 'insert', 'row': {column: _to_json_value(value) for column, value in row.items()}}
+                           for row in rows.to_dict('records')])
+
+    def append_stop(self, label, time):
+        """
+        Log the 'Transaction stop time' of a row of the database.
+        Args:
+            label: label of the row in the database
+            time: transaction stop time
+        """
+        self._append({'op': 'stop', 'label': _to_json_value(label), 'time': _to_json_value(pd.Timestamp(time))})
+
+    def append_stops(self, labels, times):
+        """
+        Log the 'Transaction stop time' of many rows of the database.
+        Args:
+            labels: labels of the rows in the database
+            times: transaction stop times
+        """
+        if len(labels):
+            self._append(*[{'op': 'stop', 'label': _to_json_value(label), 'time': _to_json_value(pd.Timestamp(time))}
+                           for label, time in zip(labels, times)])
+
+    def needs_compaction(self):
+        return self.n_events >= self.compact_every
+
+    def compact(self, db):
+        """
+        Write the database into the snapshot and start an empty journal.
+        Args:
+            db (pd.DataFrame): the database (snapshot with the journal replayed)
+        """
+        db.to_csv(self.db_path + '.tmp', index=False)
+        os.replace(self.db_path + '.tmp', self.db_path)
+        self._write_header(len(db))
+        self.snapshot_rows = len(db)
+        self.n_events = 0
@@ -1,32 +1,111 @@
 
 import pandas as pd
 import io
+import json
+import os
+import threading
 import numpy as np
 import datetime
+import contextlib
 import streamlit as st
 from dss_engine import DSS_Engine
 from KnowledgeBase import KB
+from transaction_log import TransactionLog
+from profiling import profiler
+
+
+class SharedEngine():
+    """
+    Engine and database shared by all the Streamlit sessions of the process.
+    The database (csv snapshot and journal) is read again only when it was changed by someone else,
+    the changes of update/delete are written back explicitly with save().
+    """
+    def __init__(self, db_path) -> None:
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.engine = None
+        self.mtime = None
+
+    def _mtime(self):
+        journal_path = self.engine.journal.journal_path if self.engine is not None else f'{self.db_path}.journal'
+        return os.stat(self.db_path).st_mtime_ns, os.stat(journal_path).st_mtime_ns if os.path.exists(journal_path) else None
+
+    def get(self, kb) -> DSS_Engine:
+        with self.lock:
+            mtime = self._mtime()
+            if self.engine is None or self.mtime != mtime:
+                journal = TransactionLog(self.db_path)
+                self.engine = DSS_Engine(db=journal.load(), kb=kb, journal=journal)
+                self.mtime = mtime
+            self.engine.kb = kb
+            return self.engine
+
+    def save(self) -> str:
+        with self.lock:
+            message = self.engine.save(self.db_path)
+            self.mtime = self._mtime()
+            return message
+
+
+@st.cache_resource(max_entries=1)
+def load_kb(path_dec, path_prod, mtime_dec, mtime_prod) -> KB:
+    # the mtimes are part of the cache key, so a changed spreadsheet is loaded again
+    return KB(path_dec, path_prod)
+
+
+@st.cache_resource(max_entries=1)
+def load_state_code_to_name(path, mtime) -> dict:
+    return dict(pd.read_excel(path).values)
+
+
+_debug_sessions = 0  # number of debug sessions running, the profiler is enabled while there is one
+_debug_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def debug_profiling():
+    # enable the process-wide profiler only while a debug session runs
+    global _debug_sessions
+    with _debug_lock:
+        if _debug_sessions == 0:
+            profiler.enable()
+        _debug_sessions += 1
+    try:
+        yield
+    finally:
+        with _debug_lock:
+            _debug_sessions -= 1
+            if _debug_sessions == 0:
+                profiler.disable()
+
+
+@st.cache_resource
+def get_shared_engine(db_path) -> SharedEngine:
+    return SharedEngine(db_path)
 
 
 class UI():
     def __init__(self, db_path='project_db_updated.csv', debug_mode=False) -> None:
         self.debug_mode = debug_mode
-
         self.db_path = db_path
+        if self.debug_mode:
+            # profile this run (the spans of the other sessions are kept apart by their thread)
+            with debug_profiling():
+                profiler.clear(thread=threading.get_ident())
+                self.run()
+        else:
+            self.run()
+
+    def run(self):
         # self.path_dec = path_dec
         # self.path_prod = path_prod
         
-        # read db
-        df = pd.read_csv(
-            filepath_or_buffer=self.db_path,
-            parse_dates=['Valid start time', 'Valid stop time', 'Transaction time', 'Transaction stop time']
-            )
-        
-        # init engine
-        self.cds = DSS_Engine(db=df.copy())
-        del(df)
+        # shared engine (db and kb are loaded once per process)
+        kb = load_kb('kb_dec.xlsx', 'kb_proc.xlsx', os.stat('kb_dec.xlsx').st_mtime_ns, os.stat('kb_proc.xlsx').st_mtime_ns)
+        self.shared_engine = get_shared_engine(self.db_path)
+        self.cds = self.shared_engine.get(kb)
 
-        self.state_code_to_name = dict(pd.read_excel('state_code_to_name.xlsx').values)
+        self.state_code_to_name = load_state_code_to_name('state_code_to_name.xlsx', os.stat('state_code_to_name.xlsx').st_mtime_ns)
 
         # [UI] title
         # st.title('Decision Support Systems in Medicine - Mini Project', anchor=False)
@@ -60,12 +139,31 @@ class UI():
         }        
         st.sidebar.title('Decision Support Systems in Medicine - Mini Project')
         demo_name = st.sidebar.radio("Choose a page", self.page_names_to_funcs.keys())
-        self.page_names_to_funcs[demo_name]()
+        with profiler.span('ui.page', page=demo_name):
+            self.page_names_to_funcs[demo_name]()
+        if self.debug_mode: self.page_debug()
+
+    def page_debug(self):
+        # [UI] profiling spans of this run
+        thread = threading.get_ident()
+        spans = pd.DataFrame(profiler.spans(thread=thread))
+        with st.sidebar.expander('⏱️ Profiling'):
+            if len(spans) == 0:
+                st.write('No spans recorded')
+                return
+            spans = spans.sort_values('start', kind='stable')
+            spans.insert(0, 'stage', [' ' * depth + name for depth, name in zip(spans['depth'], spans['name'])])
+            spans['duration (ms)'] = spans['duration'] * 1000
+            columns = ['stage', 'duration (ms)'] + [column for column in ['rows', 'patients', 'mode', 'memory_delta', 'error']
+                                                    if column in spans.columns]
+            st.dataframe(spans[columns], hide_index=True)
+            st.write('Query cache:', self.cds.query_cache.info())
+            st.download_button('Download trace', json.dumps(profiler.to_trace(thread=thread), default=str),
+                               file_name='cdss_trace.json', mime='application/json')
 
     def page_home(self):
-        _df = self.cds.db.copy()
-        _df['Full name'] = _df['First name'] + ' ' + _df['Last name']
-        patient_full_name_list = list(_df.drop_duplicates(['ID', 'First name', 'Last name'])['Full name'])
+        patient_full_names = self.cds.patients.full_names()
+        patient_full_name_list = list(patient_full_names)
 
         no_patient_selected_placeholder_str = '---'
         col_patient_selction, col_state_display, _, _ = st.columns(4)
@@ -83,11 +181,11 @@ class UI():
         # st.dataframe(df_treatments)
         if selected_patient == no_patient_selected_placeholder_str:
 
-            for patient_full_name in patient_full_name_list:
+            df_db_inf_all = self.cds.get_inferred_states(trans_date=trans_date, trans_time=trans_time)
+            for patient_id in patient_full_names.index:
                 # st.write('🌡️ **Patient states:**')
-                patient_id = list(set(_df[_df['Full name'].eq(patient_full_name)]['ID']))[0]
-                df_db_inf = self.cds.kb.kb_dec.inference_dec(patient_data[patient_data.ID.eq(patient_id)][['LOINC-NUM', 'Value']])
-                df_db_inf['State type'] = df_db_inf.Therapy_Code.apply(lambda x: self.cds.kb.kb_dec.get_states(x))
+                df_db_inf = df_db_inf_all[df_db_inf_all.ID.eq(patient_id)][['Therapy_Code', 'Value']].reset_index(drop=True)
+                df_db_inf['State type'] = self.cds.kb.kb_dec.map_states(df_db_inf.Therapy_Code)
                 df_db_inf['Value'] = df_db_inf.Value.map(self.state_code_to_name)
                 for state_type in set(df_db_inf['State type']):
                     try:
@@ -121,12 +219,13 @@ class UI():
             
             st.dataframe(df_states, hide_index=True)
         else:
-            selected_patient_id = list(set(_df[_df['Full name'].eq(selected_patient)]['ID']))[0]
+            selected_patient_id = patient_full_names.index[patient_full_names.eq(selected_patient)][0]
 
             
             st.write('🌡️ Patient states:')
-            df_db_inf = self.cds.kb.kb_dec.inference_dec(patient_data[patient_data.ID.eq(selected_patient_id)][['LOINC-NUM', 'Value']])
-            df_db_inf['State type'] = df_db_inf.Therapy_Code.apply(lambda x: self.cds.kb.kb_dec.get_states(x))
+            df_db_inf = self.cds.get_inferred_states(trans_date=trans_date, trans_time=trans_time)
+            df_db_inf = df_db_inf[df_db_inf.ID.eq(selected_patient_id)][['Therapy_Code', 'Value']].reset_index(drop=True)
+            df_db_inf['State type'] = self.cds.kb.kb_dec.map_states(df_db_inf.Therapy_Code)
             df_db_inf['Value'] = df_db_inf.Value.map(self.state_code_to_name)
             st.dataframe(df_db_inf[['State type', 'Value']])
 
@@ -135,7 +234,7 @@ class UI():
 
             st.write('📂 Patient history:')
             patient_data = patient_data.copy()
-            patient_data.insert(4,'LOINC-NAME', patient_data['LOINC-NUM'].map(dict(self.cds.kb.kb_dec.get_full_loinc_desc().values)))
+            patient_data.insert(4,'LOINC-NAME', self.cds.kb.kb_dec.map_loinc_desc(patient_data['LOINC-NUM']))
             st.dataframe(patient_data[
                 ~(patient_data['LOINC-NUM'].eq('Gender')) 
                 & (patient_data['ID'].eq(selected_patient_id))], 
@@ -165,17 +264,14 @@ class UI():
         col_from_valid_date_picker, col_from_valid_time_picker, col_to_valid_date_picker, col_to_valid_time_picker = st.columns(4)  
 
         with col_loinc_selection:
-            _df = self.cds.db.copy()
-            loinc_num_full_list = list(set(list(_df.drop_duplicates(['LOINC-NUM'])['LOINC-NUM'])) - set(['Gender']))
-            loinc_num_full_list = [f'{loinc_num} -- {dict(self.cds.kb.kb_dec.get_full_loinc_desc().values)[loinc_num]}' for loinc_num in loinc_num_full_list]
+            loinc_num_full_list = list(set(self.cds.db['LOINC-NUM'].unique()) - set(['Gender']))
+            loinc_num_full_list = [f'{loinc_num} -- {self.cds.kb.kb_dec.get_loinc_desc(loinc_num)}' for loinc_num in loinc_num_full_list]
             selected_loinc = st.selectbox('LOINC-NUM:  ', loinc_num_full_list)
             selected_loinc = selected_loinc.split(' -- ')[0]
             if self.debug_mode: st.write(selected_loinc)
         
         with col_patient_selection:
-            _df = self.cds.db.copy()
-            _df['Full name'] = _df['First name'] + ' ' + _df['Last name']
-            patient_full_name_list = list(_df.drop_duplicates(['ID', 'First name', 'Last name'])['Full name'])
+            patient_full_name_list = list(self.cds.patients.full_names())
             selected_patient = st.selectbox('Patient name: ', patient_full_name_list)
             if self.debug_mode: st.write(selected_patient)
 
@@ -251,7 +347,7 @@ class UI():
         st.info(history_retrieve_command_preview_text, icon="🗒️")
 
         patient_histroy_data = patient_histroy_data.copy()
-        patient_histroy_data.insert(4,'LOINC-NAME', patient_histroy_data['LOINC-NUM'].map(dict(self.cds.kb.kb_dec.get_full_loinc_desc().values)))
+        patient_histroy_data.insert(4,'LOINC-NAME', self.cds.kb.kb_dec.map_loinc_desc(patient_histroy_data['LOINC-NUM']))
         st.dataframe(patient_histroy_data, hide_index=True)
 
     def page_update(self):
@@ -262,17 +358,14 @@ class UI():
             col_valid_date_picker, col_valid_time_picker = st.columns(2)
             
             with col_loinc_selection:
-                _df = self.cds.db.copy()
-                loinc_num_full_list = list(set(list(_df.drop_duplicates(['LOINC-NUM'])['LOINC-NUM'])) - set(['Gender']))
-                loinc_num_full_list = [f'{loinc_num} -- {dict(self.cds.kb.kb_dec.get_full_loinc_desc().values)[loinc_num]}' for loinc_num in loinc_num_full_list]
+                loinc_num_full_list = list(set(self.cds.db['LOINC-NUM'].unique()) - set(['Gender']))
+                loinc_num_full_list = [f'{loinc_num} -- {self.cds.kb.kb_dec.get_loinc_desc(loinc_num)}' for loinc_num in loinc_num_full_list]
                 selected_loinc = st.selectbox('LOINC-NUM:', loinc_num_full_list)
                 selected_loinc = selected_loinc.split(' -- ')[0]
                 if self.debug_mode: st.write(selected_loinc)
                         
             with col_patient_selection:
-                _df = self.cds.db.copy()
-                _df['Full name'] = _df['First name'] + ' ' + _df['Last name']
-                patient_full_name_list = list(_df.drop_duplicates(['ID', 'First name', 'Last name'])['Full name'])
+                patient_full_name_list = list(self.cds.patients.full_names())
                 selected_patient = st.selectbox('Patient name:     ', patient_full_name_list)
                 if self.debug_mode: st.write(selected_patient)
 
@@ -325,25 +418,26 @@ class UI():
             st.warning('Data not selected')              
 
         if button_submitted:
-            selected_row, new_row = self.cds.update(
-                        loinc=selected_loinc, 
-                        first_name=selected_patient.split()[0], 
-                        last_name=selected_patient.split()[1], 
-                        trans_date=f'{self.date_current}', 
-                        trans_time=f'{self.time_current.hour}:{self.time_current.minute}', 
-                        component_date=f'{date_valid}', 
-                        component_time=None if time_valid_value == None else f'{time_valid_value.hour}:{time_valid_value.minute}',
-                        new_value=text_input_new_loinc_value,
-                        )
-            if type(selected_row) == int and selected_row == -1:
-                st.error('Data does not exist', icon="🚨")
-            else:
-                st.success('Data update', icon="🖊️")
-                self.cds.save(self.db_path)
-                st.write('Selected row:')
-                st.write(selected_row, hide_index=True)
-                st.write('New row:')
-                st.write(new_row, hide_index=True)
+            with self.shared_engine.lock:
+                selected_row, new_row = self.cds.update(
+                            loinc=selected_loinc, 
+                            first_name=selected_patient.split()[0], 
+                            last_name=selected_patient.split()[1], 
+                            trans_date=f'{self.date_current}', 
+                            trans_time=f'{self.time_current.hour}:{self.time_current.minute}', 
+                            component_date=f'{date_valid}', 
+                            component_time=None if time_valid_value == None else f'{time_valid_value.hour}:{time_valid_value.minute}',
+                            new_value=text_input_new_loinc_value,
+                            )
+                if type(selected_row) == int and selected_row == -1:
+                    st.error('Data does not exist', icon="🚨")
+                else:
+                    st.success('Data update', icon="🖊️")
+                    self.shared_engine.save()
+                    st.write('Selected row:')
+                    st.write(selected_row, hide_index=True)
+                    st.write('New row:')
+                    st.write(new_row, hide_index=True)
 
         max_valid_datetime = self.cds.db['Valid start time'].max()
         max_valid_date = datetime.date(day=  max_valid_datetime.day,  month=  max_valid_datetime.month, year= max_valid_datetime.year)
@@ -369,7 +463,7 @@ class UI():
         )
         st.write('Retrieved history:')
         patient_histroy_data = patient_histroy_data.copy()
-        patient_histroy_data.insert(4,'LOINC-NAME', patient_histroy_data['LOINC-NUM'].map(dict(self.cds.kb.kb_dec.get_full_loinc_desc().values)))
+        patient_histroy_data.insert(4,'LOINC-NAME', self.cds.kb.kb_dec.map_loinc_desc(patient_histroy_data['LOINC-NUM']))
 
         try:
             st.dataframe(patient_histroy_data.style.apply(lambda x: ['background-color: lemonchiffon' if x.name in list(selected_row_preview.index) else '' for i in x], axis=1), hide_index=True)
@@ -383,17 +477,14 @@ class UI():
         col_delete, _,  _, _= st.columns(4)
         
         with col_loinc_selection:
-            _df = self.cds.db.copy()
-            loinc_num_full_list = list(set(list(_df.drop_duplicates(['LOINC-NUM'])['LOINC-NUM'])) - set(['Gender']))
-            loinc_num_full_list = [f'{loinc_num} -- {dict(self.cds.kb.kb_dec.get_full_loinc_desc().values)[loinc_num]}' for loinc_num in loinc_num_full_list]
+            loinc_num_full_list = list(set(self.cds.db['LOINC-NUM'].unique()) - set(['Gender']))
+            loinc_num_full_list = [f'{loinc_num} -- {self.cds.kb.kb_dec.get_loinc_desc(loinc_num)}' for loinc_num in loinc_num_full_list]
             selected_loinc = st.selectbox('LOINC-NUM: ', loinc_num_full_list)
             selected_loinc = selected_loinc.split(' -- ')[0]
             if self.debug_mode: st.write(selected_loinc)
                     
         with col_patient_selection:
-            _df = self.cds.db.copy()
-            _df['Full name'] = _df['First name'] + ' ' + _df['Last name']
-            patient_full_name_list = list(_df.drop_duplicates(['ID', 'First name', 'Last name'])['Full name'])
+            patient_full_name_list = list(self.cds.patients.full_names())
             selected_patient = st.selectbox('Patient name:', patient_full_name_list)
             if self.debug_mode: st.write(selected_patient)
 
@@ -468,23 +559,24 @@ class UI():
         button_delete = st.button('Submit')
         
         if button_delete:
-            selected_row = self.cds.delete(
-                        loinc=selected_loinc, 
-                        first_name=selected_patient.split()[0], 
-                        last_name=selected_patient.split()[1], 
-                        trans_date=selected_deletion_date, 
-                        trans_time= selected_deletion_time, 
-                        component_date=selected_valid_date, 
-                        component_time=selected_valid_time
-                        )
-            if type(selected_row) == int and selected_row == -1: 
-                st.error('Data does not exist', icon="🚨")
-            else:
-                self.cds.save(self.db_path)
-                st.write('Deleted row:')
-                st.dataframe(selected_row.to_frame().transpose(), hide_index=True)
-                st.success('Deleted data successfully', icon="❌")
-                
+            with self.shared_engine.lock:
+                selected_row = self.cds.delete(
+                            loinc=selected_loinc, 
+                            first_name=selected_patient.split()[0], 
+                            last_name=selected_patient.split()[1], 
+                            trans_date=selected_deletion_date, 
+                            trans_time= selected_deletion_time, 
+                            component_date=selected_valid_date, 
+                            component_time=selected_valid_time
+                            )
+                if type(selected_row) == int and selected_row == -1: 
+                    st.error('Data does not exist', icon="🚨")
+                else:
+                    self.shared_engine.save()
+                    st.write('Deleted row:')
+                    st.dataframe(selected_row.to_frame().transpose(), hide_index=True)
+                    st.success('Deleted data successfully', icon="❌")
+
         
 
         max_valid_datetime = self.cds.db['Valid start time'].max()
@@ -512,7 +604,7 @@ class UI():
 
         
         patient_histroy_data = patient_histroy_data.copy()
-        patient_histroy_data.insert(4,'LOINC-NAME', patient_histroy_data['LOINC-NUM'].map(dict(self.cds.kb.kb_dec.get_full_loinc_desc().values)))
+        patient_histroy_data.insert(4,'LOINC-NAME', self.cds.kb.kb_dec.map_loinc_desc(patient_histroy_data['LOINC-NUM']))
         
         st.write('Retrieved history:')
         try:
@@ -527,18 +619,15 @@ class UI():
         col_valid_date_picker, col_valid_time_picker, col_valid_time_disabler, _ = st.columns(4)  
 
         with col_loinc_selection:
-            _df = self.cds.db.copy()
-            loinc_num_full_list = list(set(list(_df.drop_duplicates(['LOINC-NUM'])['LOINC-NUM'])) - set(['Gender']))
-            loinc_num_full_list = [f'{loinc_num} -- {dict(self.cds.kb.kb_dec.get_full_loinc_desc().values)[loinc_num]}' for loinc_num in loinc_num_full_list]
+            loinc_num_full_list = list(set(self.cds.db['LOINC-NUM'].unique()) - set(['Gender']))
+            loinc_num_full_list = [f'{loinc_num} -- {self.cds.kb.kb_dec.get_loinc_desc(loinc_num)}' for loinc_num in loinc_num_full_list]
             selected_loinc = st.selectbox('LOINC-NUM:   ', loinc_num_full_list)
             selected_loinc = selected_loinc.split(' -- ')[0]
             if self.debug_mode: st.write(selected_loinc)
               
         
         with col_patient_selection:
-            _df = self.cds.db.copy()
-            _df['Full name'] = _df['First name'] + ' ' + _df['Last name']
-            patient_full_name_list = list(_df.drop_duplicates(['ID', 'First name', 'Last name'])['Full name'])
+            patient_full_name_list = list(self.cds.patients.full_names())
             selected_patient = st.selectbox('Patient name:  ', patient_full_name_list)
             if self.debug_mode: st.write(selected_patient)
 
@@ -592,4 +681,4 @@ class UI():
     
 if __name__ == '__main__':
     st.set_page_config(page_title='CDSS', page_icon=None, layout="wide", initial_sidebar_state="auto", menu_items=None)
-    ui = UI(debug_mode=False)
\ No newline at end of file
+    ui = UI(debug_mode=os.environ.get('CDSS_DEBUG') == '1')
\ No newline at end of file